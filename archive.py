@@ -0,0 +1,165 @@
+"""
+Columnar archive of a rotated month: logYYYYMM.txt -> logYYYYMM.columns
+
+The same sessions as the text file, stored as columns of numbers that are memory-mapped and scanned
+without parsing a single line. The text file stays where it is and remains the reference: an archive
+is only used if it was made from a file of the same size, otherwise it's ignored.
+
+Layout, little endian, a 32 byte header followed by the columns:
+
+	header    "WEEELAB1", sessions, users, size of the text file (8 bytes), length of user table, length of blob
+	login     int32 per session, minutes since 2000-01-01 00:00
+	logout    int32 per session, same, -1 if still in lab when the log was rotated
+	duration  int32 per session, minutes, 0 if still in lab
+	user      int32 per session, index in the user table
+	message   uint32 per session plus one, where each message starts in the blob: the next one is where it ends
+	users     user names, UTF-8, separated by newlines
+	blob      messages, UTF-8, one after the other
+"""
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from logparse import iter_records
+
+MAGIC = b"WEEELAB1"
+_HEADER = struct.Struct("<8sIIQII")
+EPOCH = datetime(2000, 1, 1)
+
+
+def archive_filename(path: str) -> str:
+	"""
+	log201901.txt -> log201901.columns
+	"""
+	return path.rsplit('.', 1)[0] + ".columns"
+
+
+def to_minutes(when: datetime) -> int:
+	return int((when - EPOCH).total_seconds()) // 60
+
+
+def from_minutes(minutes: int) -> datetime:
+	return EPOCH + timedelta(minutes=minutes)
+
+
+def _little_endian(column: array) -> bytes:
+	if sys.byteorder == 'big':
+		column = array(column.typecode, column)
+		column.byteswap()
+	return column.tobytes()
+
+
+def write_archive(path: str):
+	"""
+	Build the archive for a rotated log file
+
+	:param path: Path to the rotated log file
+	"""
+	logins = array('i')
+	logouts = array('i')
+	durations = array('i')
+	users = array('i')
+	messages = array('I', [0])
+	user_ids = {}
+	blob = bytearray()
+	for record in iter_records(path):
+		logins.append(to_minutes(record.login))
+		if record.inlab:
+			logouts.append(-1)
+			durations.append(0)
+		else:
+			logouts.append(to_minutes(record.logout))
+			durations.append(record.duration)
+		users.append(user_ids.setdefault(record.username, len(user_ids)))
+		if record.message is not None:
+			blob += record.message.encode('utf-8')
+		messages.append(len(blob))
+
+	names = "\n".join(user_ids).encode('utf-8')
+	tmp_filename = archive_filename(path) + ".tmp"
+	with open(tmp_filename, "wb") as archive_file:
+		archive_file.write(_HEADER.pack(MAGIC, len(logins), len(user_ids), os.stat(path).st_size, len(names), len(blob)))
+		for column in (logins, logouts, durations, users, messages):
+			archive_file.write(_little_endian(column))
+		archive_file.write(names)
+		archive_file.write(blob)
+	os.replace(tmp_filename, archive_filename(path))
+
+
+class Archive:
+	"""
+	An archive, mapped in memory. Columns are sequences of ints backed directly by the file:
+	login, logout, duration, user, message. Close it when done, or use it in a with block.
+	"""
+
+	def __init__(self, archive_file, source_size: int):
+		self._mmap = mmap.mmap(archive_file.fileno(), 0, access=mmap.ACCESS_READ)
+		self._views = []
+		try:
+			magic, count, user_count, size, names_length, blob_length = _HEADER.unpack_from(self._mmap)
+			expected = _HEADER.size + count * 16 + (count + 1) * 4 + names_length + blob_length
+			if magic != MAGIC or size != source_size or len(self._mmap) != expected:
+				raise ValueError("Not an archive of this file")
+			self.count = count
+			start = _HEADER.size
+			self.login = self._column(start, count, 'i')
+			self.logout = self._column(start + count * 4, count, 'i')
+			self.duration = self._column(start + count * 8, count, 'i')
+			self.user = self._column(start + count * 12, count, 'i')
+			self.message = self._column(start + count * 16, count + 1, 'I')
+			start += count * 16 + (count + 1) * 4
+			names = self._mmap[start:start + names_length].decode('utf-8')
+			self.users: List[str] = names.split("\n") if user_count > 0 else []
+			self._blob_start = start + names_length
+		except BaseException:
+			self.close()
+			raise
+
+	def _column(self, start: int, count: int, typecode: str):
+		if sys.byteorder == 'big':
+			column = array(typecode, self._mmap[start:start + count * 4])
+			column.byteswap()
+			return column
+		view = memoryview(self._mmap)[start:start + count * 4].cast(typecode)
+		self._views.append(view)
+		return view
+
+	def message_of(self, index: int) -> Optional[str]:
+		start = self._blob_start + self.message[index]
+		end = self._blob_start + self.message[index + 1]
+		if start == end:
+			return None
+		return self._mmap[start:end].decode('utf-8')
+
+	def close(self):
+		# The map can't be closed while something still points into it
+		for view in self._views:
+			view.release()
+		self._views = []
+		self._mmap.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+
+def open_archive(path: str) -> Optional[Archive]:
+	"""
+	Map the archive of a rotated log file
+
+	:param path: Path to the rotated log file
+	:return: The archive, None if there's none or it doesn't match the file anymore
+	"""
+	try:
+		source_size = os.stat(path).st_size
+		with open(archive_filename(path), "rb") as archive_file:
+			return Archive(archive_file, source_size)
+	except (OSError, ValueError, struct.error):
+		return None
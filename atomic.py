@@ -0,0 +1,41 @@
+"""
+Replacing small files (indexes, caches) that many weeelab instances may be writing at the same time.
+
+Each writer gets its own temporary file next to the real one, so nobody renames away someone else's half-written
+file: the last rename wins and readers always see a whole file, either the old one or a new one.
+"""
+
+import json
+import os
+import tempfile
+
+# Temporary files are created 0600, give them what open() would have
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def replace_json(filename: str, data, mode: int = 0o666) -> os.stat_result:
+	"""
+	Atomically replace a file with some JSON
+
+	:param filename: File to replace
+	:param data: Anything json.dump can write
+	:param mode: Permissions, before applying the umask
+	:return: Stat of the file just written, to tell later if someone else has replaced it
+	"""
+	directory, name = os.path.split(os.path.abspath(filename))
+	fd, tmp_filename = tempfile.mkstemp(prefix=name + ".", suffix=".tmp", dir=directory)
+	try:
+		with os.fdopen(fd, "w") as tmp_file:
+			os.fchmod(tmp_file.fileno(), mode & ~_UMASK)
+			json.dump(data, tmp_file)
+			tmp_file.flush()
+			stat = os.fstat(tmp_file.fileno())
+		os.replace(tmp_filename, filename)
+		return stat
+	except BaseException:
+		try:
+			os.remove(tmp_filename)
+		except OSError:
+			pass
+		raise
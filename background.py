@@ -0,0 +1,85 @@
+"""
+Run something slow (an LDAP lookup, mostly) in a thread while the main one waits for a human to type.
+"""
+
+import io
+import sys
+import threading
+from typing import Callable
+
+
+class _ThreadOutput:
+	"""
+	Stands in for sys.stdout: text printed by some threads is held back, everything else goes through
+	"""
+
+	def __init__(self, stdout):
+		self.stdout = stdout
+		# thread ident -> buffer
+		self.held = {}
+
+	def write(self, text):
+		held = self.held.get(threading.get_ident())
+		if held is None:
+			return self.stdout.write(text)
+		return held.write(text)
+
+	def __getattr__(self, name):
+		# fileno, isatty, flush... so input() still sees a terminal and keeps line editing
+		return getattr(self.stdout, name)
+
+
+class Background:
+	"""
+	Start a function in a thread right away, get its result (or its exception) with join().
+	Whatever it prints is shown only when joining, so it can't end up in the middle of a prompt.
+	"""
+
+	def __init__(self, function: Callable, *args):
+		self._function = function
+		self._args = args
+		self._result = None
+		self._exception = None
+		self._output = io.StringIO()
+		self._stdout = sys.stdout
+		if isinstance(sys.stdout, _ThreadOutput):
+			self._proxy = sys.stdout
+		else:
+			self._proxy = sys.stdout = _ThreadOutput(sys.stdout)
+		# Daemon: if the main thread exits (e.g. ctrl+C at the prompt), don't wait for LDAP
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def _run(self):
+		self._proxy.held[threading.get_ident()] = self._output
+		try:
+			self._result = self._function(*self._args)
+		except BaseException as e:
+			self._exception = e
+		finally:
+			del self._proxy.held[threading.get_ident()]
+
+	def done(self, timeout: float = 0) -> bool:
+		"""
+		Check if the function has finished, waiting for it a little at most
+
+		:param timeout: Seconds to wait
+		:return: True if it has, so join() won't wait
+		"""
+		if timeout > 0:
+			self._thread.join(timeout)
+		return not self._thread.is_alive()
+
+	def join(self):
+		"""
+		Wait for the function to finish
+
+		:return: What it returned, or raise what it raised
+		"""
+		self._thread.join()
+		if sys.stdout is self._proxy and len(self._proxy.held) == 0:
+			sys.stdout = self._stdout
+		self._stdout.write(self._output.getvalue())
+		if self._exception is not None:
+			raise self._exception
+		return self._result
@@ -0,0 +1,37 @@
+"""
+Read a file from the end: the last lines cost the same however big the file is.
+"""
+
+import os
+from typing import Iterator, Tuple
+
+BLOCK_SIZE = 64 * 1024
+
+
+def lines_backwards(filename: str, block_size: int = BLOCK_SIZE) -> Iterator[Tuple[int, bytes]]:
+	"""
+	Stream the lines of a file from the last to the first, reading blocks backwards from the end
+
+	:param filename: Path to the file
+	:param block_size: How much to read at a time
+	:return: Byte offset where the line starts and the line, with its newline (the last one may have none)
+	"""
+	with open(filename, "rb") as the_file:
+		position = the_file.seek(0, os.SEEK_END)
+		# Beginning of a line that started in a block not read yet
+		rest = b""
+		while position > 0:
+			size = min(block_size, position)
+			position -= size
+			the_file.seek(position)
+			block = the_file.read(size) + rest
+			end = len(block)
+			# Newline of the line before, not the one ending this line
+			cut = block.rfind(b"\n", 0, end - 1)
+			while cut >= 0:
+				yield position + cut + 1, block[cut + 1:end]
+				end = cut + 1
+				cut = block.rfind(b"\n", 0, end - 1)
+			rest = block[:end]
+		if len(rest) > 0:
+			yield 0, rest
@@ -0,0 +1,187 @@
+"""
+Replay of many login/logout events at once: after a network outage, or to copy paper sign sheets.
+
+Events come from a CSV file with an "action,username,time,message" header or from a JSONL file with the same
+keys, one object per line. Action is login or logout, time is "dd/mm/YYYY HH:MM" like in the log (ISO 8601 works
+too), message is only for logouts.
+
+Events are checked in time order against who is in lab, then turned into journal changes that can all be
+committed together: the log is written once, under the lock, for the whole file.
+"""
+
+import csv
+import json
+import os
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from constans import MAX_WORK_DONE
+from logparse import format_duration, parse_line
+from presence import PresenceIndex
+
+
+class Event:
+	__slots__ = ('line', 'action', 'username', 'time', 'message')
+
+	def __init__(self, line: int, action: str, username: str, time: datetime, message: Optional[str]):
+		# where it is in the batch file, to point at it in errors
+		self.line = line
+		self.action = action
+		self.username = username
+		self.time = time
+		self.message = message
+
+	def __str__(self):
+		text = f"{self.action.ljust(6)} {self.time.strftime('%d/%m/%Y %H:%M')} {self.username}"
+		if self.message is not None:
+			text += f" :: {self.message}"
+		return text
+
+
+def _parse_time(value: str) -> datetime:
+	value = value.strip()
+	try:
+		return datetime.strptime(value, "%d/%m/%Y %H:%M")
+	except ValueError:
+		return datetime.fromisoformat(value).replace(second=0, microsecond=0, tzinfo=None)
+
+
+def _event(line: int, data: dict) -> Event:
+	action = str(data.get('action') or "").strip().lower()
+	if action not in ('login', 'logout'):
+		raise ValueError(f"action must be login or logout, not \"{action}\"")
+	username = str(data.get('username') or "").strip()
+	if username == "":
+		raise ValueError(f"username is missing")
+	try:
+		time = _parse_time(str(data.get('time') or ""))
+	except ValueError:
+		raise ValueError(f"time must be dd/mm/YYYY HH:MM, not \"{data.get('time')}\"")
+	message = data.get('message')
+	if message is not None:
+		message = " ".join(str(message).split())
+		if message == "":
+			message = None
+	if action == 'logout':
+		if message is None:
+			raise ValueError(f"a logout needs a message")
+		if len(message) > MAX_WORK_DONE:
+			raise ValueError(f"message is longer than {MAX_WORK_DONE} characters")
+	else:
+		message = None
+	return Event(line, action, username, time, message)
+
+
+def read_events(filename: str) -> Tuple[List[Event], List[str]]:
+	"""
+	Read a batch file, CSV or JSONL depending on the extension (or on what it looks like)
+
+	:param filename: Path to the batch file
+	:return: Events, in file order, and errors for lines that couldn't be understood
+	"""
+	events = []
+	errors = []
+	with open(filename, "r", newline='') as batch_file:
+		if filename.endswith(".csv"):
+			jsonl = False
+		elif filename.endswith(".jsonl") or filename.endswith(".json"):
+			jsonl = True
+		else:
+			jsonl = batch_file.read(1) == "{"
+			batch_file.seek(0)
+
+		if jsonl:
+			for number, line in enumerate(batch_file, 1):
+				if line.strip() == "":
+					continue
+				try:
+					data = json.loads(line)
+					if not isinstance(data, dict):
+						raise ValueError(f"not a JSON object")
+					events.append(_event(number, data))
+				except ValueError as e:
+					errors.append(f"Line {number}: {e}")
+		else:
+			reader = csv.DictReader(batch_file)
+			for data in reader:
+				try:
+					events.append(_event(reader.line_num, data))
+				except ValueError as e:
+					errors.append(f"Line {reader.line_num}: {e}")
+	return events, errors
+
+
+def plan(events: List[Event], log_filename: str, index: PresenceIndex) -> Tuple[List[dict], List[str]]:
+	"""
+	Turn events into journal changes, checking each one against who is in lab at that moment.
+	Usernames must be the real ones already. Hold the log lock while calling this and committing the changes.
+
+	:param events: What to do
+	:param log_filename: Path to log file
+	:param index: Presence index, up to date with the log
+	:return: Changes to commit, errors (if there's any, nothing should be committed)
+	"""
+	size = os.path.getsize(log_filename)
+	# start of the last line in the log, if it's an open session: only that one can get its message inline
+	last_start = None
+	# the last line may have no newline, closing it adds one
+	last_newline = True
+	# username -> offset of the [INLAB] line, login time
+	inlab: Dict[str, Tuple[int, datetime]] = {}
+	with open(log_filename, "rb") as log_file:
+		for username in index.usernames():
+			offset = index.offset(username)
+			log_file.seek(offset)
+			line = log_file.readline()
+			inlab[username] = (offset, parse_line(line, offset).login)
+			if offset + len(line) == size:
+				last_start = offset
+				last_newline = line.endswith(b"\n")
+
+	now = datetime.now()
+	changes = []
+	errors = []
+	for event in sorted(events, key=lambda e: e.time):
+		where = f"Line {event.line}"
+		if event.time > now:
+			errors.append(f"{where}: {event.time.strftime('%d/%m/%Y %H:%M')} is in the future")
+		elif (event.time.year, event.time.month) != (now.year, now.month):
+			errors.append(f"{where}: {event.time.strftime('%d/%m/%Y')} belongs to the log of another month")
+		elif event.action == 'login':
+			if event.username in inlab:
+				errors.append(f"{where}: {event.username} is already in lab at {event.time.strftime('%d/%m/%Y %H:%M')}")
+				continue
+			line = f"[{event.time.strftime('%d/%m/%Y %H:%M')}] [----------------] [INLAB] <{event.username}>\n"
+			changes.append({'op': 'append', 'offset': size, 'line': line})
+			inlab[event.username] = (size, event.time)
+			last_start = size
+			last_newline = True
+			size += len(line.encode('utf-8'))
+		else:
+			if event.username not in inlab:
+				errors.append(f"{where}: {event.username} isn't in lab at {event.time.strftime('%d/%m/%Y %H:%M')}")
+				continue
+			offset, login_time = inlab[event.username]
+			minutes = int((event.time - login_time).total_seconds()) // 60
+			duration = format_duration(minutes)
+			if minutes < 0:
+				errors.append(f"{where}: {event.username} logs out before logging in")
+				continue
+			if len(duration) != 5:
+				errors.append(f"{where}: {event.username} would have been in lab for {duration}, that's too long")
+				continue
+			end = None
+			if offset == last_start:
+				end = size
+				size += len(f" :: {event.message}".encode('utf-8')) + (0 if last_newline else 1)
+				last_start = None
+			changes.append({
+				'op': 'close',
+				'offset': offset,
+				'logout': event.time.strftime("%d/%m/%Y %H:%M"),
+				'duration': duration,
+				'message': event.message,
+				'end': end,
+			})
+			del inlab[event.username]
+	return changes, errors
@@ -0,0 +1,649 @@
+"""
+Benchmarks for weeelab, to compare versions before and after a change.
+
+startup: how long weeelab takes to start for each action and how much of it goes into imports. Each action
+runs in a fresh interpreter with python -X importtime, without daemon and LDAP, on a log file in a
+temporary directory.
+
+ops: latency and throughput of the hot paths (login, logout, inlab, is_logged_in, rotation, stats, card reader),
+called directly on synthetic logs of any size. LDAP is replaced by a fake directory that answers
+everything after a configurable delay, so no server is needed and the network cost is still there.
+Results can be saved as JSON and compared with a previous run.
+
+generate: just write a synthetic log, to try things by hand.
+
+swipes: check the card decoder against a corpus of swipes (swipes.jsonl) and time it.
+
+stress: many weeelab processes at once on the same log (logins, logouts, -p, --watch), then check that every
+session has been closed exactly once with its message and that no process crashed. Exits with 1 if anything failed.
+
+metrics: percentiles from a metrics file written by weeelab --metrics, i.e. from real usage.
+
+python benchmark.py startup [--runs N] [--top N]
+python benchmark.py ops [--lines N] [--open N] [--ops N] [--ldap-latency MS] [--save FILE] [--compare FILE]
+python benchmark.py generate FILE [--lines N] [--open N] [--previous-month]
+python benchmark.py swipes [FILE] [--repeat N]
+python benchmark.py stress [--users N] [--rounds N] [--readers N] [--watchers N] [--lines N]
+python benchmark.py metrics FILE
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import types
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from statistics import median
+from time import perf_counter, sleep
+from typing import Callable, Dict, List, Optional, Tuple
+
+WEEELAB = os.path.join(os.path.dirname(os.path.realpath(__file__)), "weeelab.py")
+SWIPES = os.path.join(os.path.dirname(os.path.realpath(__file__)), "swipes.jsonl")
+
+# name -> command line arguments, run in this order since logout needs someone to log out
+ACTIONS = [
+	('help', ['--help']),
+	('inlab', ['-p']),
+	('login', ['-i', 'bench.user']),
+	('logout', ['-o', 'bench.user', '-m', 'benchmark']),
+	('log', ['-l']),
+	('stats', ['--stats']),
+	('totals', ['--totals']),
+]
+
+_WORDS = ("fixed", "tested", "a", "the", "PC", "laptop", "RAM", "inventory", "T.A.R.A.L.L.O.", "cables",
+		  "sorted", "screws", "for", "hours", "nothing", "motherboard", "PSU", "cleaned", "lab", "meeting")
+
+
+def parse_importtime(stderr: str) -> Tuple[int, Dict[str, int]]:
+	"""
+	Read the output of -X importtime
+
+	:param stderr: What the interpreter printed
+	:return: Total microseconds spent importing, top-level module -> cumulative microseconds
+	"""
+	total = 0
+	modules = {}
+	for line in stderr.splitlines():
+		if not line.startswith("import time:"):
+			continue
+		fields = line[len("import time:"):].split("|")
+		try:
+			self_us = int(fields[0])
+			cumulative_us = int(fields[1])
+		except (IndexError, ValueError):
+			# The header
+			continue
+		total += self_us
+		name = fields[2]
+		# Nested imports are indented by two spaces per level
+		if not name[1:].startswith(" "):
+			modules[name.strip()] = cumulative_us
+	return total, modules
+
+
+def run_action(args: List[str], log_path: str) -> Tuple[float, int, Dict[str, int]]:
+	"""
+	Run weeelab once
+
+	:param args: Command line arguments
+	:param log_path: Where the log is
+	:return: Wall time in seconds, import time in microseconds, top-level module -> cumulative microseconds
+	"""
+	env = dict(os.environ, LOG_PATH=log_path)
+	start = perf_counter()
+	process = subprocess.run([sys.executable, "-X", "importtime", WEEELAB] + args + ["--no-daemon", "--no-ldap"],
+							 env=env, cwd=log_path, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+							 stdin=subprocess.DEVNULL, universal_newlines=True)
+	elapsed = perf_counter() - start
+	if process.returncode != 0:
+		errors = [line for line in process.stderr.splitlines() if not line.startswith("import time:")]
+		print(f"weeelab {' '.join(args)} failed with code {process.returncode}", file=sys.stderr)
+		print("\n".join(errors), file=sys.stderr)
+	total, modules = parse_importtime(process.stderr)
+	return elapsed, total, modules
+
+
+def startup(runs: int, top: int):
+	wall: Dict[str, List[float]] = {name: [] for name, _ in ACTIONS}
+	imports: Dict[str, List[int]] = {name: [] for name, _ in ACTIONS}
+	modules: Dict[str, Dict[str, List[int]]] = {name: {} for name, _ in ACTIONS}
+	for _ in range(runs):
+		with tempfile.TemporaryDirectory() as log_path:
+			for name, args in ACTIONS:
+				elapsed, total, run_modules = run_action(args, log_path)
+				wall[name].append(elapsed)
+				imports[name].append(total)
+				for module, cumulative in run_modules.items():
+					modules[name].setdefault(module, []).append(cumulative)
+
+	print(f"{'action':<10} {'wall ms':>9} {'imports ms':>11}  slowest imports")
+	for name, _ in ACTIONS:
+		slowest = sorted(((median(times), module) for module, times in modules[name].items()), reverse=True)[:top]
+		slowest = ", ".join(f"{module} {us / 1000:.1f}" for us, module in slowest)
+		print(f"{name:<10} {median(wall[name]) * 1000:>9.1f} {median(imports[name]) / 1000:>11.1f}  {slowest}")
+
+
+def _log_time(when: datetime) -> str:
+	# Way faster than strftime, which matters for a few million lines
+	return f"{when.day:02d}/{when.month:02d}/{when.year} {when.hour:02d}:{when.minute:02d}"
+
+
+def generate_log(filename: str, lines: int, open_sessions: int, users: int = 300, previous_month: bool = False,
+				 seed: int = 0) -> List[str]:
+	"""
+	Write a log that looks like a real one: sessions spread over the month in login order, with messages,
+	and some users still in lab among the last lines.
+
+	:param filename: Where to write it
+	:param lines: How many lines
+	:param open_sessions: How many of them are [INLAB]
+	:param users: How many different people come to the lab
+	:param previous_month: Date it last month, so the next run has to rotate it
+	:param seed: Same seed, same log
+	:return: Usernames of who is in lab
+	"""
+	rng = random.Random(seed)
+	now = datetime.now().replace(second=0, microsecond=0)
+	start = now.replace(day=1, hour=0, minute=0)
+	if previous_month:
+		end = start - timedelta(minutes=1)
+		start = end.replace(day=1, hour=0, minute=0)
+	else:
+		end = now
+	span = (end - start).total_seconds() / 60
+
+	open_sessions = min(open_sessions, lines, users)
+	pool = [f"name{i:04d}.surname{i:04d}" for i in range(users)]
+	inlab = rng.sample(pool, open_sessions)
+	inlab_set = set(inlab)
+	others = [username for username in pool if username not in inlab_set] or pool
+	# Open sessions are mixed with the most recent closed ones, as it happens when people leave in any order
+	tail = min(lines, open_sessions * 4)
+	open_at = set(rng.sample(range(lines - tail, lines), open_sessions))
+
+	inlab_iter = iter(inlab)
+	buffer = []
+	with open(filename, "w") as log_file:
+		for i in range(lines):
+			login = start + timedelta(minutes=int(span * i / lines))
+			if i in open_at:
+				buffer.append(f"[{_log_time(login)}] [----------------] [INLAB] <{next(inlab_iter)}>\n")
+			else:
+				minutes = rng.randint(5, 8 * 60)
+				message = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(1, 12)))
+				buffer.append(f"[{_log_time(login)}] [{_log_time(login + timedelta(minutes=minutes))}] "
+							  f"[{minutes // 60:02d}:{minutes % 60:02d}] <{rng.choice(others)}> :: {message}\n")
+			if len(buffer) >= 10000:
+				log_file.write("".join(buffer))
+				buffer = []
+		log_file.write("".join(buffer))
+	return inlab
+
+
+def load_swipes(filename: str = SWIPES) -> List[dict]:
+	"""
+	Read the swipe corpus: one JSON object per line, with input, expected matricola and direction, and a note
+	"""
+	with open(filename, "r") as swipes_file:
+		return [json.loads(line) for line in swipes_file if line.strip() != ""]
+
+
+def install_fake_ldap(latency: float, users: int = 2000):
+	"""
+	Replace python-ldap with a directory that knows everyone, answering after a delay.
+
+	Every uid or nickname exists, unless it starts with "nobody"; matricola 123456 belongs to s123456.
+	Paged searches return a few thousand people.
+
+	:param latency: Seconds for each round trip
+	:param users: How many people a paged search returns
+	"""
+	ldap = types.ModuleType("ldap")
+	ldap_filter = types.ModuleType("ldap.filter")
+	ldap_controls = types.ModuleType("ldap.controls")
+
+	class LDAPError(Exception):
+		pass
+
+	class SERVER_DOWN(LDAPError):
+		pass
+
+	class SimplePagedResultsControl:
+		controlType = "1.2.840.113556.1.4.319"
+
+		def __init__(self, criticality=True, size=10, cookie=''):
+			self.criticality = criticality
+			self.size = size
+			self.cookie = cookie
+
+	def entry(uid: str, matricola: Optional[str] = None) -> tuple:
+		matricola = matricola if matricola is not None else str(sum(uid.encode()) % 1000000).zfill(6)
+		return f"uid={uid},ou=People", {
+			'uid': [uid.encode()],
+			'cn': [uid.replace(".", " ").title().encode()],
+			'givenname': [uid.split(".")[0].title().encode()],
+			'signedsir': [b'true'],
+			'weeelabnickname': [uid.replace(".", "").encode()],
+			'schacpersonaluniquecode': [f"s{matricola}".encode()],
+		}
+
+	def search(the_filter: str) -> list:
+		clauses = re.findall(r"\((uid|weeelabnickname|schacpersonaluniquecode)=([^)]*)\)", the_filter)
+		if len(clauses) == 0:
+			# Everyone, as in --refresh-user-cache
+			return [entry(f"name{i:04d}.surname{i:04d}") for i in range(users)]
+		results = {}
+		for attribute, value in clauses:
+			if attribute == 'schacpersonaluniquecode':
+				results[value] = entry(f"s{value[1:]}", value[1:])
+			elif not value.startswith("nobody"):
+				# uid and nickname clauses come in pairs with the same value, the uid is the one that matches
+				results.setdefault(value, entry(value))
+		return list(results.values())
+
+	class Connection:
+		def __init__(self):
+			self.protocol_version = None
+			self._pending = {}
+
+		def start_tls_s(self):
+			sleep(latency)
+
+		def simple_bind_s(self, who, cred):
+			sleep(latency)
+
+		def search_s(self, base, scope, the_filter, attributes):
+			sleep(latency)
+			return search(the_filter)
+
+		def search_ext(self, base, scope, the_filter, attributes, serverctrls=None):
+			msgid = len(self._pending) + 1
+			self._pending[msgid] = search(the_filter)
+			return msgid
+
+		def result3(self, msgid):
+			sleep(latency)
+			return 101, self._pending.pop(msgid), msgid, []
+
+		def unbind_s(self):
+			pass
+
+	ldap.LDAPError = LDAPError
+	ldap.SERVER_DOWN = SERVER_DOWN
+	ldap.VERSION3 = 3
+	ldap.SCOPE_SUBTREE = 2
+	ldap.initialize = lambda uri: Connection()
+	ldap_filter.escape_filter_chars = lambda value: re.sub(r"[\\*()\x00]", lambda match: f"\\{ord(match.group()):02x}", value)
+	ldap_controls.SimplePagedResultsControl = SimplePagedResultsControl
+	ldap.filter = ldap_filter
+	ldap.controls = ldap_controls
+	sys.modules['ldap'] = ldap
+	sys.modules['ldap.filter'] = ldap_filter
+	sys.modules['ldap.controls'] = ldap_controls
+
+
+def _measure(operation: Callable, arguments: list) -> List[float]:
+	"""
+	Call an operation once per argument, with its output thrown away
+
+	:return: Seconds taken by each call
+	"""
+	times = []
+	with redirect_stdout(io.StringIO()) as output:
+		for argument in arguments:
+			start = perf_counter()
+			operation(argument)
+			times.append(perf_counter() - start)
+			output.seek(0)
+			output.truncate()
+	return times
+
+
+def _summarize(times: List[float]) -> dict:
+	ordered = sorted(times)
+	return {
+		'n': len(ordered),
+		'median_ms': median(ordered) * 1000,
+		'p95_ms': _percentile(ordered, 0.95) * 1000,
+		'max_ms': ordered[-1] * 1000,
+		'ops_per_s': len(ordered) / sum(ordered) if sum(ordered) > 0 else float('inf'),
+	}
+
+
+def ops(lines: int, open_sessions: int, count: int, ldap_latency: float, rotations: int) -> dict:
+	"""
+	Measure the hot paths on synthetic logs
+
+	:param lines: Lines in the log
+	:param open_sessions: Users in lab at the start
+	:param count: Calls for each operation
+	:param ldap_latency: Seconds for each LDAP round trip
+	:param rotations: How many times to rotate a log (each time a new one has to be generated)
+	:return: Operation -> statistics
+	"""
+	with tempfile.TemporaryDirectory() as log_path:
+		# constans reads these when imported
+		os.environ['LOG_PATH'] = log_path
+		os.environ['LDAP_SERVER'] = "ldap://fake.example.com"
+		os.environ['LDAP_TREE'] = "ou=People,dc=example,dc=com"
+		install_fake_ldap(ldap_latency)
+		import history
+		import utils
+
+		def fresh_log(name: str, previous_month: bool = False) -> List[str]:
+			os.mkdir(os.path.join(log_path, name))
+			utils.LOG_FILENAME = os.path.join(log_path, name, "log.txt")
+			utils._presence = None
+			utils._totals = None
+			return generate_log(utils.LOG_FILENAME, lines, open_sessions, previous_month=previous_month)
+
+		results = {}
+		rng = random.Random(0)
+
+		inlab = fresh_log("main")
+		# First load parses the whole log, then the index is on disk
+		results['presence (first load)'] = _measure(lambda _: utils.presence(), [None])
+		candidates = inlab + [f"name{i:04d}.surname{i:04d}" for i in range(count)]
+		results['is_logged_in'] = _measure(utils.is_logged_in, [rng.choice(candidates) for _ in range(count)])
+		results['inlab'] = _measure(lambda _: utils.inlab(), range(count))
+
+		def inlab_cold(_):
+			# As a new process would do: the index comes from disk
+			utils._presence = None
+			utils.inlab()
+
+		results['inlab (from disk)'] = _measure(inlab_cold, range(count))
+		results['create_backup_if_necessary'] = _measure(lambda _: utils.create_backup_if_necessary(), range(count))
+
+		new_users = [f"bench.user{i:05d}" for i in range(count)]
+		results['login (LDAP)'] = _measure(lambda username: utils.login(username, True), new_users)
+		leaving = inlab + new_users
+		rng.shuffle(leaving)
+		results['logout'] = _measure(lambda username: utils.logout(username, True, "benchmark"), leaving)
+		# They're in the user cache now
+		results['login (cached)'] = _measure(lambda username: utils.login(username, True), new_users)
+
+		rotation_times = []
+		for rotation in range(rotations):
+			fresh_log(f"rotate{rotation}", previous_month=True)
+			rotation_times.extend(_measure(lambda _: utils.create_backup_if_necessary(), [None]))
+		if rotation_times:
+			results['rotation'] = rotation_times
+			# Part of the month, so the summary can't be used
+			rotated = utils.LOG_FILENAME.rsplit('.', 1)[0] + (datetime.now().replace(day=1) - timedelta(days=1)).strftime("%Y%m") + ".txt"
+			since = datetime.now().replace(day=1) - timedelta(days=20)
+			results['month stats (text)'] = _measure(lambda _: history.text_stats(rotated, since), [None])
+			results['month stats (archive)'] = _measure(lambda _: history.archive_stats(rotated, since), [None])
+
+		corpus = [swipe['input'] for swipe in load_swipes()]
+		results['read_from_card_reader'] = _measure(utils.read_from_card_reader, [corpus[i % len(corpus)] for i in range(count)])
+
+	return {name: _summarize(times) for name, times in results.items()}
+
+
+def print_ops(results: dict, previous: Optional[dict] = None):
+	header = f"{'operation':<28} {'n':>6} {'median ms':>10} {'p95 ms':>9} {'max ms':>9} {'ops/s':>10}"
+	if previous is not None:
+		header += f" {'vs before':>10}"
+	print(header)
+	for name, result in results.items():
+		line = f"{name:<28} {result['n']:>6} {result['median_ms']:>10.3f} {result['p95_ms']:>9.3f} {result['max_ms']:>9.3f} {result['ops_per_s']:>10.1f}"
+		if previous is not None:
+			before = previous.get(name)
+			if before is None or before['median_ms'] == 0:
+				line += f" {'-':>10}"
+			else:
+				line += f" {result['median_ms'] / before['median_ms']:>9.2f}x"
+		print(line)
+
+
+def decode_swipes(filename: str, repeat: int) -> bool:
+	"""
+	Check the card decoder against the corpus and time it on every swipe
+
+	:param filename: Corpus file
+	:param repeat: Times to decode each swipe
+	:return: True if every swipe was decoded as expected
+	"""
+	from cardreader import get_decoder
+	decoder = get_decoder()
+	correct = True
+	slowest = 0.0
+	print(f"{'swipe':<36} {'result':<24} {'median us':>10} {'max us':>8}")
+	for swipe in load_swipes(filename):
+		expected = None if swipe['matricola'] is None else (swipe['matricola'], swipe['direction'])
+		decoded = decoder.decode(swipe['input'])
+		times = []
+		for _ in range(repeat):
+			start = perf_counter()
+			decoder.decode(swipe['input'])
+			times.append(perf_counter() - start)
+		slowest = max(slowest, max(times))
+		label = swipe['input'] if len(swipe['input']) <= 32 else swipe['input'][:29] + "..."
+		result = "-" if decoded is None else f"{decoded[0]} {decoded[1] or ''}"
+		if decoded != expected:
+			correct = False
+			result = f"WRONG {result}"
+		print(f"{label:<36} {result:<24} {median(times) * 1e6:>10.2f} {max(times) * 1e6:>8.2f}")
+	print(f"Slowest decode: {slowest * 1e6:.2f} us")
+	return correct
+
+
+def _run_weeelab(args: List[str], env: dict, cwd: str) -> Tuple[int, str, str]:
+	process = subprocess.run([sys.executable, WEEELAB] + args + ["--no-daemon", "--no-ldap"], env=env, cwd=cwd,
+							 stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+							 universal_newlines=True)
+	return process.returncode, process.stdout, process.stderr
+
+
+def stress(users: int, rounds: int, readers: int, watchers: int, lines: int) -> bool:
+	"""
+	Many weeelab processes at the same time on the same log: users logging in and out, -p in a loop and
+	--watch screens, starting from a stale presence index. Then check that nothing went wrong.
+
+	:param users: Users logging in and out, each one in its own sequence of processes
+	:param rounds: Login and logout pairs for each user
+	:param readers: Processes running -p in a loop until the users are done
+	:param watchers: --watch processes running all the time
+	:param lines: Lines in the log before starting
+	:return: True if every check passed
+	"""
+	from concurrent.futures import ThreadPoolExecutor
+	from signal import SIGINT
+	from threading import Event
+	from logparse import iter_records
+
+	problems = []
+
+	def check(returncode: int, stdout: str, stderr: str, what: str, expected: Optional[str] = None):
+		if "Traceback" in stderr:
+			problems.append(f"{what} crashed:\n{stderr}")
+		elif returncode != 0:
+			problems.append(f"{what} exited with {returncode}:\n{stdout}{stderr}")
+		elif expected is not None and expected not in stdout:
+			problems.append(f"{what} didn't say \"{expected}\":\n{stdout}")
+
+	with tempfile.TemporaryDirectory() as log_path:
+		env = dict(os.environ, LOG_PATH=log_path)
+		log_filename = os.path.join(log_path, "log.txt")
+		generate_log(log_filename, lines, min(10, lines))
+		# Leave an index on disk, then add lines behind its back: everyone starts from a stale index
+		check(*_run_weeelab(["-i", "stress.warmup"], env, log_path), "login stress.warmup", "Login successful")
+		check(*_run_weeelab(["-o", "stress.warmup", "-m", "warmup"], env, log_path), "logout stress.warmup",
+			  "Logout successful")
+		more = os.path.join(log_path, "more.txt")
+		generate_log(more, min(1000, lines), 0, seed=1)
+		with open(more, "rb") as more_file, open(log_filename, "ab") as log_file:
+			log_file.write(more_file.read())
+		os.remove(more)
+		done = Event()
+
+		def user(number: int):
+			username = f"stress.user{number:03d}"
+			for round_number in range(rounds):
+				check(*_run_weeelab(["-i", username], env, log_path), f"login {username}", "Login successful")
+				message = f"stress {username} round {round_number}"
+				check(*_run_weeelab(["-o", username, "-m", message], env, log_path), f"logout {username}",
+					  "Logout successful")
+
+		def reader(_):
+			while not done.is_set():
+				check(*_run_weeelab(["-p"], env, log_path), "-p")
+
+		watch_processes = [subprocess.Popen([sys.executable, WEEELAB, "--watch", "--no-daemon", "--no-ldap"], env=env,
+											cwd=log_path, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+											stderr=subprocess.PIPE, universal_newlines=True) for _ in range(watchers)]
+		start = perf_counter()
+		with ThreadPoolExecutor(users + readers) as executor:
+			reading = [executor.submit(reader, number) for number in range(readers)]
+			try:
+				for future in [executor.submit(user, number) for number in range(users)]:
+					future.result()
+			finally:
+				done.set()
+			for future in reading:
+				future.result()
+		elapsed = perf_counter() - start
+		for process in watch_processes:
+			process.send_signal(SIGINT)
+			check(process.wait(), "", process.communicate()[1], "--watch")
+
+		# Every session closed exactly once, with its own message
+		expected = {f"stress stress.user{number:03d} round {round_number}"
+					for number in range(users) for round_number in range(rounds)}
+		expected.add("warmup")
+		seen = {}
+		for record in iter_records(log_filename):
+			if not record.username.startswith("stress."):
+				continue
+			if record.inlab:
+				problems.append(f"{record.username} is still in lab: {record}")
+			elif record.message not in expected:
+				problems.append(f"Unexpected message: {record}")
+			else:
+				seen[record.message] = seen.get(record.message, 0) + 1
+		for message in sorted(expected):
+			if seen.get(message, 0) != 1:
+				problems.append(f"\"{message}\" is in the log {seen.get(message, 0)} times")
+
+	print(f"{users} users x {rounds} rounds, {readers} readers, {watchers} watchers: {elapsed:.1f} s")
+	for problem in problems:
+		print(problem)
+	print("OK" if len(problems) == 0 else f"{len(problems)} problems")
+	return len(problems) == 0
+
+
+def _percentile(ordered: List[float], fraction: float) -> float:
+	return ordered[int(fraction * (len(ordered) - 1))]
+
+
+def metrics(metrics_filename: str):
+	"""
+	Print p50 and p99 of every action and of every phase in it, from a metrics file
+
+	:param metrics_filename: Written by weeelab --metrics
+	"""
+	# action -> phase ("total" for the whole run) -> milliseconds
+	timings: Dict[str, Dict[str, List[float]]] = {}
+	with open(metrics_filename, "r") as metrics_file:
+		for line in metrics_file:
+			try:
+				record = json.loads(line)
+				action = timings.setdefault(record['action'], {})
+				action.setdefault('total', []).append(record['total_ms'])
+				for name, ms in record['spans'].items():
+					action.setdefault(name, []).append(ms)
+			except (ValueError, KeyError, TypeError, AttributeError):
+				# Half-written line, or something else entirely
+				continue
+
+	print(f"{'action / phase':<32} {'n':>6} {'p50 ms':>9} {'p99 ms':>9}")
+	for action, phases in sorted(timings.items()):
+		for name, values in phases.items():
+			ordered = sorted(values)
+			label = action if name == 'total' else f"  {name}"
+			print(f"{label:<32} {len(ordered):>6} {_percentile(ordered, 0.5):>9.1f} {_percentile(ordered, 0.99):>9.1f}")
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Measure weeelab performance")
+	commands = parser.add_subparsers(dest='command')
+	commands.required = True
+
+	startup_parser = commands.add_parser('startup', help='cold start time for each action')
+	startup_parser.add_argument('--runs', type=int, default=5, help='how many times to run each action')
+	startup_parser.add_argument('--top', type=int, default=5, help='how many of the slowest imports to show')
+
+	ops_parser = commands.add_parser('ops', help='latency and throughput of each operation')
+	ops_parser.add_argument('--lines', type=int, default=100000, help='lines in the synthetic log')
+	ops_parser.add_argument('--open', type=int, default=20, help='users in lab in the synthetic log')
+	ops_parser.add_argument('--ops', type=int, default=200, help='calls for each operation')
+	ops_parser.add_argument('--ldap-latency', type=float, default=20, metavar='MS', help='delay of the fake LDAP server')
+	ops_parser.add_argument('--rotations', type=int, default=3, help='how many logs to rotate')
+	ops_parser.add_argument('--save', metavar='FILE', help='write results as JSON here')
+	ops_parser.add_argument('--compare', metavar='FILE', help='compare with results saved by a previous run')
+
+	generate_parser = commands.add_parser('generate', help='write a synthetic log')
+	generate_parser.add_argument('file', help='where to write it')
+	generate_parser.add_argument('--lines', type=int, default=100000, help='how many lines')
+	generate_parser.add_argument('--open', type=int, default=20, help='how many users in lab')
+	generate_parser.add_argument('--users', type=int, default=300, help='how many different users')
+	generate_parser.add_argument('--previous-month', action='store_true', help='date it last month')
+
+	swipes_parser = commands.add_parser('swipes', help='check and time the card decoder on a corpus of swipes')
+	swipes_parser.add_argument('file', nargs='?', default=SWIPES, help='corpus, JSON lines (default: swipes.jsonl)')
+	swipes_parser.add_argument('--repeat', type=int, default=1000, help='times to decode each swipe')
+
+	stress_parser = commands.add_parser('stress', help='concurrent processes on the same log, checking the result')
+	stress_parser.add_argument('--users', type=int, default=20, help='users logging in and out at the same time')
+	stress_parser.add_argument('--rounds', type=int, default=5, help='login and logout pairs for each user')
+	stress_parser.add_argument('--readers', type=int, default=4, help='processes running -p in a loop')
+	stress_parser.add_argument('--watchers', type=int, default=2, help='--watch processes')
+	stress_parser.add_argument('--lines', type=int, default=10000, help='lines in the log before starting')
+
+	metrics_parser = commands.add_parser('metrics', help='percentiles from a metrics file')
+	metrics_parser.add_argument('file', help='written by weeelab --metrics')
+
+	args = parser.parse_args()
+	if args.command == 'startup':
+		startup(args.runs, args.top)
+	elif args.command == 'ops':
+		previous = None
+		if args.compare is not None:
+			with open(args.compare, "r") as compare_file:
+				previous = json.load(compare_file)['results']
+		results = ops(args.lines, args.open, args.ops, args.ldap_latency / 1000, args.rotations)
+		print_ops(results, previous)
+		if args.save is not None:
+			from constans import VERSION
+			with open(args.save, "w") as save_file:
+				json.dump({
+					'version': VERSION,
+					'python': sys.version.split()[0],
+					'lines': args.lines,
+					'open': args.open,
+					'ldap_latency_ms': args.ldap_latency,
+					'results': results,
+				}, save_file, indent=1)
+	elif args.command == 'generate':
+		inlab = generate_log(args.file, args.lines, args.open, args.users, args.previous_month)
+		print(f"{args.lines} lines written, {len(inlab)} users in lab")
+	elif args.command == 'swipes':
+		if not decode_swipes(args.file, args.repeat):
+			sys.exit(1)
+	elif args.command == 'stress':
+		if not stress(args.users, args.rounds, args.readers, args.watchers, args.lines):
+			sys.exit(1)
+	elif args.command == 'metrics':
+		metrics(args.file)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,101 @@
+"""
+Decoding of magnetic card swipes, which arrive at the prompt as a line of text like anything typed.
+
+Every known reader layout is a regular expression with a "matricola" group, plus the direction of the swipe
+if the layout tells it. All of them are joined into a single expression, so a line is scanned once no matter
+how many layouts there are. Nothing in them can backtrack badly and lines longer than any swipe are not even
+looked at, so decoding always takes a few microseconds.
+
+More layouts can be added with a JSON file, pointed to by CARD_LAYOUTS_FILENAME in .env:
+
+	[{"name": "new reader", "pattern": "^%(?P<matricola>\\\\d{6})\\\\?$", "direction": "left to right"}]
+
+Layouts are tried in order, the ones from the file after the built-in ones.
+"""
+
+import json
+import re
+from typing import List, Optional, Tuple
+
+from constans import CARD_LAYOUTS_FILENAME
+
+# Anything longer is not a swipe
+MAX_SWIPE_LENGTH = 256
+
+# name, pattern, direction (None if unknown)
+LAYOUTS = [
+	("ò, old format", r"^ò.{8}(?P<matricola>\d{6}).*-$", "top to bottom"),
+	("ò, old format", r"^ò.{8}(?P<matricola>\d{6}).*_$", "bottom to top"),
+	("semicolon, old format", r"^;.{8}(?P<matricola>\d{6}).*/$", "top to bottom"),
+	("semicolon, old format", r"^;.{8}(?P<matricola>\d{6}).*\?$", "bottom to top"),
+	("ò, new format", r"ò0000.{4}(?P<matricola>\d{6})..", None),
+	("semicolon, new format", r";0000.{4}(?P<matricola>\d{6})..", None),
+]
+
+
+class CardDecoder:
+	def __init__(self, layouts: List[Tuple[str, str, Optional[str]]]):
+		"""
+		:param layouts: name, pattern with a "matricola" group, direction or None
+		"""
+		self.layouts = []
+		alternatives = []
+		for name, pattern, direction in layouts:
+			compiled = re.compile(pattern)
+			if set(compiled.groupindex) != {'matricola'} or compiled.groups != 1:
+				raise ValueError(f"Card layout \"{name}\" must have one group, named matricola, and no other groups")
+			# Each layout gets its own group name, to know which one matched
+			alternatives.append(f"(?:{pattern.replace('(?P<matricola>', f'(?P<m{len(self.layouts)}>')})")
+			self.layouts.append((name, direction))
+		self._regex = re.compile("|".join(alternatives)) if len(alternatives) > 0 else None
+
+	def decode(self, text: str) -> Optional[Tuple[str, Optional[str]]]:
+		"""
+		Find out if a line is a card swipe
+
+		:param text: The line
+		:return: Matricola (only digits) and direction of the swipe if known, None if it's not a swipe
+		"""
+		if self._regex is None or len(text) > MAX_SWIPE_LENGTH:
+			return None
+		match = self._regex.search(text)
+		if match is None:
+			return None
+		for index, (name, direction) in enumerate(self.layouts):
+			matricola = match.group(f"m{index}")
+			if matricola is not None:
+				return matricola, direction
+		return None
+
+
+def load_layouts(filename: str) -> List[Tuple[str, str, Optional[str]]]:
+	"""
+	Read more layouts from a JSON file. A broken file shouldn't stop anyone from logging in: complain and go on.
+
+	:param filename: Path to the file
+	:return: The layouts, maybe none
+	"""
+	layouts = []
+	try:
+		with open(filename, "r") as layouts_file:
+			for layout in json.load(layouts_file):
+				layout = (str(layout['name']), str(layout['pattern']), layout.get('direction'))
+				# Check it now, a single bad one would break the combined expression
+				CardDecoder([layout])
+				layouts.append(layout)
+	except (OSError, ValueError, KeyError, TypeError, AttributeError, re.error) as e:
+		print(f"Ignoring card layouts from {filename}: {e}")
+	return layouts
+
+
+def get_decoder() -> CardDecoder:
+	global _decoder
+	if _decoder is None:
+		layouts = list(LAYOUTS)
+		if CARD_LAYOUTS_FILENAME:
+			layouts.extend(load_layouts(CARD_LAYOUTS_FILENAME))
+		_decoder = CardDecoder(layouts)
+	return _decoder
+
+
+_decoder = None
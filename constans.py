@@ -1,17 +1,63 @@
-from dotenv import load_dotenv
-from utils import getuser
+import json
 import os
 
-load_dotenv(os.path.join(os.path.dirname(os.path.realpath(__file__)), '.env'))
+
+def _load_env(env_filename: str):
+	"""
+	Put variables from .env into the environment, without overwriting those already there.
+	python-dotenv takes longer to import than everything else, so the parsed file is cached in .env.json
+	and used as long as .env doesn't change.
+
+	:param env_filename: Path to .env
+	"""
+	try:
+		mtime = os.stat(env_filename).st_mtime_ns
+	except OSError:
+		return
+	cache_filename = env_filename + ".json"
+	values = None
+	try:
+		with open(cache_filename, "r") as cache_file:
+			cache = json.load(cache_file)
+		if cache['mtime'] == mtime:
+			values = cache['values']
+	except (OSError, ValueError, KeyError, TypeError):
+		pass
+	if not isinstance(values, dict):
+		from dotenv import dotenv_values
+		values = {key: value for key, value in dotenv_values(env_filename).items() if value is not None}
+		try:
+			# Same secrets as .env, same care: only the owner can read it
+			tmp_filename = cache_filename + ".tmp"
+			with os.fdopen(os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as cache_file:
+				json.dump({'mtime': mtime, 'values': values}, cache_file)
+			os.replace(tmp_filename, cache_filename)
+		except OSError:
+			# Read-only installation, parse it every time
+			pass
+	for key, value in values.items():
+		os.environ.setdefault(key, value)
+
+
+def __getattr__(name: str):
+	# getpass is needed only by who asks for this, compute it on demand
+	if name == 'HOST_USER':
+		from getpass import getuser
+		return getuser()
+	raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+_load_env(os.path.join(os.path.dirname(os.path.realpath(__file__)), '.env'))
 
 COLOR_RED = "\033[1;31m"
 COLOR_NATIVE = "\033[m"
 
 VERSION = "3.2"
 PROGRAM_NAME = __file__.split('/')[-1]
-HOST_USER = getuser()
 DEBUG_MODE = False  # Don't set it here, use -d when running
 MAX_WORK_DONE = 2000
+CLOSE_MESSAGE = os.getenv("CLOSE_MESSAGE", "Forgot to log out, session closed by an admin")
+LOCK_TIMEOUT = float(os.getenv("LOCK_TIMEOUT", 10))  # seconds
 
 LDAP_SERVER = os.getenv("LDAP_SERVER")
 LDAP_BIND_DN = os.getenv("LDAP_BIND_DN")
@@ -19,8 +65,17 @@ LDAP_PASSWORD = os.getenv("LDAP_PASSWORD")
 LDAP_TREE = os.getenv("LDAP_TREE")
 LOG_PATH = os.getenv("LOG_PATH")
 LOG_FILENAME = LOG_PATH + "/log.txt"
+USER_CACHE_FILENAME = os.getenv("USER_CACHE_FILENAME", LOG_PATH + "/usercache.json")
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 24 * 60 * 60))  # seconds
+USER_CACHE_MAX = int(os.getenv("USER_CACHE_MAX", 2000))
+SOCKET_FILENAME = os.getenv("SOCKET_FILENAME", LOG_PATH + "/weeelab.sock")
+CARD_LAYOUTS_FILENAME = os.getenv("CARD_LAYOUTS_FILENAME")  # more card reader layouts, see cardreader.py
+METRICS_FILENAME = os.getenv("METRICS_FILENAME")  # None to not record timings
 FIRST_IN = os.getenv("FIRST_IN_SCRIPT_PATH")
 LAST_OUT = os.getenv("LAST_OUT_SCRIPT_PATH")
+HOOKS_LOG_FILENAME = os.getenv("HOOKS_LOG_FILENAME", LOG_PATH + "/hooks.jsonl")
+HOOK_TIMEOUT = float(os.getenv("HOOK_TIMEOUT", 5 * 60))  # seconds
+HOOK_CONCURRENCY = int(os.getenv("HOOK_CONCURRENCY", 1))  # scripts running at the same time
 
 FIRST_IN_HAPPENED = False
 LAST_OUT_HAPPENED = False
@@ -0,0 +1,169 @@
+"""
+Long-running weeelab: keeps presence index, user cache and LDAP connection warm and answers
+requests on a Unix domain socket, so kiosk buttons don't start from scratch every time.
+
+Protocol: the client sends one JSON object on a line, the daemon answers with one JSON object on a line
+and closes the connection. Requests look like {"action": "login", "username": "foo", "ldap": true},
+answers contain the text to show to the user, the result and which events happened. Interactive logins and
+logouts ask their questions on the client side and send the answers, "check_logout" tells whether the user is
+in lab before asking for the message.
+"""
+
+import io
+import json
+import os
+import socket
+from contextlib import redirect_stdout
+from typing import Optional
+
+import timing
+# utils (and LDAP with it) is imported in handle(): clients only need forward() and shouldn't wait for it
+
+# Forwarding is pointless if the daemon is stuck, direct mode is better
+CLIENT_TIMEOUT = 30
+
+
+def handle(request: dict) -> dict:
+	"""
+	Run one request, as if weeelab had been started with those parameters.
+
+	:param request: The decoded request
+	:return: The response
+	"""
+	import utils
+	from user import LdapError, UserNotFoundError
+	from locking import LockTimeoutError
+
+	utils.FIRST_IN_HAPPENED = False
+	utils.LAST_OUT_HAPPENED = False
+	utils.SIR_HAPPENED = False
+
+	action = request.get('action')
+	use_ldap = request.get('ldap', True)
+	profile = request.get('profile', False)
+	if profile:
+		timing.enable()
+	output = io.StringIO()
+	result = True
+	ldap_error = False
+	with redirect_stdout(output):
+		try:
+			utils.ensure_log_file()
+			utils.create_backup_if_necessary()
+			if action == 'login':
+				utils.login(request['username'], use_ldap)
+			elif action == 'logout':
+				if request.get('message') is None:
+					# Can't ask anything, there's nobody on this side
+					print(f"A logout message is required")
+					result = False
+				else:
+					result = utils.logout(request['username'], use_ldap, request['message'])
+			elif action == 'check_logout':
+				result = utils.check_logout(request['username'], use_ldap)
+			elif action == 'inlab':
+				utils.inlab(request.get('format', 'text'))
+			elif action == 'ping':
+				pass
+			else:
+				print(f"Unknown action {action}")
+				result = False
+		except LdapError:
+			# The client may want to ask whether to retry or go on without LDAP
+			ldap_error = True
+			result = False
+		except (UserNotFoundError, LockTimeoutError):
+			result = False
+		except SystemExit as e:
+			# secure_exit was called
+			result = e.code == 0
+	response = {
+		'output': output.getvalue(),
+		'result': bool(result),
+		'first_in': utils.FIRST_IN_HAPPENED,
+		'last_out': utils.LAST_OUT_HAPPENED,
+		'sir': utils.SIR_HAPPENED,
+		'ldap_error': ldap_error,
+	}
+	if profile:
+		response['spans'] = timing.spans()
+		timing.disable()
+	return response
+
+
+def _handle_connection(rfile, wfile):
+	try:
+		request = json.loads(rfile.readline())
+	except ValueError:
+		return
+	if not isinstance(request, dict):
+		return
+	response = handle(request)
+	wfile.write(json.dumps(response).encode('utf-8') + b"\n")
+
+
+def serve(socket_filename: str):
+	"""
+	Answer requests forever. One at a time, so there's no need to lock anything between them.
+
+	:param socket_filename: Where to listen
+	"""
+	if os.path.exists(socket_filename):
+		if forward(socket_filename, {'action': 'ping'}) is not None:
+			print(f"Another weeelab is already listening on {socket_filename}")
+			return False
+		os.remove(socket_filename)
+	# Only the daemon needs these, clients shouldn't pay for importing them
+	import signal
+	import socketserver
+	import threading
+	# Now rather than on the first request
+	import utils
+
+	class Handler(socketserver.StreamRequestHandler):
+		def handle(self):
+			_handle_connection(self.rfile, self.wfile)
+
+	with socketserver.UnixStreamServer(socket_filename, Handler) as server:
+		# systemd and friends stop services with SIGTERM: finish the request being handled, if any, then stop as
+		# with ctrl+C. Exiting right away from here would be caught by handle() as a secure_exit and the daemon
+		# would keep going. shutdown() waits for serve_forever() to return, which runs in this thread, so it's
+		# called from another one.
+		signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+		print(f"Listening on {socket_filename}")
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			os.remove(socket_filename)
+	return True
+
+
+def forward(socket_filename: str, request: dict) -> Optional[dict]:
+	"""
+	Send a request to the daemon, if there's one
+
+	:param socket_filename: Where the daemon is listening
+	:param request: What to ask
+	:return: The response, None if no daemon answered
+	"""
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+		client.settimeout(CLIENT_TIMEOUT)
+		try:
+			client.connect(socket_filename)
+		except OSError:
+			return None
+		# From now on the daemon may have done something, falling back to direct mode could do it twice
+		try:
+			client.sendall(json.dumps(request).encode('utf-8') + b"\n")
+			with client.makefile("rb") as response:
+				return json.loads(response.readline())
+		except (OSError, ValueError):
+			return {
+				'output': "The weeelab daemon did not answer properly\n",
+				'result': False,
+				'first_in': False,
+				'last_out': False,
+				'sir': False,
+			}
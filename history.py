@@ -0,0 +1,288 @@
+"""
+Queries over the whole history: current log plus every rotated logYYYYMM.txt next to it.
+
+Each file is read by a separate process, then the partial results are merged.
+Rotated months never change, so their statistics are computed once and stored in a summary
+file next to them (logYYYYMM.summary.json): whole months are read from there. Parts of a month
+come from its columnar archive (see archive.py), if there's one, instead of parsing the text.
+"""
+
+import glob
+import json
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from archive import from_minutes, open_archive, to_minutes, write_archive
+from logparse import LogRecord, iter_records
+
+
+class UserStats:
+	__slots__ = ('minutes', 'sessions', 'first_seen', 'last_seen', 'hours')
+
+	def __init__(self, minutes: int = 0, sessions: int = 0, first_seen: Optional[datetime] = None,
+				 last_seen: Optional[datetime] = None, hours: Optional[List[int]] = None):
+		self.minutes = minutes
+		self.sessions = sessions
+		self.first_seen = first_seen
+		self.last_seen = last_seen
+		# sessions started at each hour of the day
+		self.hours = [0] * 24 if hours is None else hours
+
+	def add(self, record: LogRecord):
+		self.sessions += 1
+		self.hours[record.login.hour] += 1
+		if record.inlab:
+			seen = record.login
+		else:
+			seen = record.logout
+			self.minutes += record.duration
+		if self.first_seen is None or record.login < self.first_seen:
+			self.first_seen = record.login
+		if self.last_seen is None or seen > self.last_seen:
+			self.last_seen = seen
+
+	def merge(self, other: 'UserStats'):
+		self.minutes += other.minutes
+		self.sessions += other.sessions
+		if self.first_seen is None or (other.first_seen is not None and other.first_seen < self.first_seen):
+			self.first_seen = other.first_seen
+		if self.last_seen is None or (other.last_seen is not None and other.last_seen > self.last_seen):
+			self.last_seen = other.last_seen
+		self.hours = [mine + theirs for mine, theirs in zip(self.hours, other.hours)]
+
+	def to_dict(self) -> dict:
+		return {
+			'minutes': self.minutes,
+			'sessions': self.sessions,
+			'first_seen': self.first_seen.isoformat(),
+			'last_seen': self.last_seen.isoformat(),
+			'hours': self.hours,
+		}
+
+	@staticmethod
+	def from_dict(data: dict) -> 'UserStats':
+		return UserStats(
+			data['minutes'],
+			data['sessions'],
+			datetime.fromisoformat(data['first_seen']),
+			datetime.fromisoformat(data['last_seen']),
+			data['hours']
+		)
+
+
+def log_files(log_filename: str) -> List[Tuple[str, Optional[int]]]:
+	"""
+	Find rotated logs and the current one.
+
+	:param log_filename: Path to the current log file
+	:return: (path, YYYYMM) for every rotated file, oldest first, then (log_filename, None)
+	"""
+	prefix = log_filename.rsplit('.', 1)[0]
+	files = []
+	for path in glob.glob(glob.escape(prefix) + "[0-9][0-9][0-9][0-9][0-9][0-9].txt"):
+		files.append((path, int(path[len(prefix):len(prefix) + 6])))
+	files.sort(key=lambda file: file[1])
+	if os.path.exists(log_filename):
+		files.append((log_filename, None))
+	return files
+
+
+def _month_in_range(month: Optional[int], since: Optional[datetime], until: Optional[datetime]) -> bool:
+	if month is None:
+		return True
+	if since is not None and month < since.year * 100 + since.month:
+		return False
+	if until is not None and month > until.year * 100 + until.month:
+		return False
+	return True
+
+
+def file_stats(path: str, since: Optional[datetime] = None, until: Optional[datetime] = None) -> Dict[str, UserStats]:
+	"""
+	Statistics for a single file, counting sessions that started between since and until (included).
+	From the columnar archive if there's one, from the text otherwise.
+	"""
+	stats = archive_stats(path, since, until)
+	if stats is None:
+		stats = text_stats(path, since, until)
+	return stats
+
+
+def archive_stats(path: str, since: Optional[datetime] = None, until: Optional[datetime] = None) -> Optional[Dict[str, UserStats]]:
+	"""
+	Same as file_stats, scanning the columns of the archive
+
+	:return: The statistics, None if the file has no valid archive
+	"""
+	archive = open_archive(path)
+	if archive is None:
+		return None
+	with archive:
+		lowest = -2 ** 31 if since is None else to_minutes(since)
+		highest = 2 ** 31 if until is None else to_minutes(until)
+		user_count = len(archive.users)
+		minutes = [0] * user_count
+		sessions = [0] * user_count
+		first_seen = [2 ** 31] * user_count
+		last_seen = [-2 ** 31] * user_count
+		hours = [[0] * 24 for _ in range(user_count)]
+		for login, logout, duration, user in zip(archive.login, archive.logout, archive.duration, archive.user):
+			if login < lowest or login > highest:
+				continue
+			sessions[user] += 1
+			hours[user][login // 60 % 24] += 1
+			if logout < 0:
+				seen = login
+			else:
+				seen = logout
+				minutes[user] += duration
+			if login < first_seen[user]:
+				first_seen[user] = login
+			if seen > last_seen[user]:
+				last_seen[user] = seen
+		return {
+			username: UserStats(minutes[user], sessions[user], from_minutes(first_seen[user]),
+								from_minutes(last_seen[user]), hours[user])
+			for user, username in enumerate(archive.users) if sessions[user] > 0
+		}
+
+
+def text_stats(path: str, since: Optional[datetime] = None, until: Optional[datetime] = None) -> Dict[str, UserStats]:
+	"""
+	Same as file_stats, parsing the text
+	"""
+	stats = {}
+	for record in iter_records(path):
+		if since is not None and record.login < since:
+			continue
+		if until is not None and record.login > until:
+			continue
+		user_stats = stats.get(record.username)
+		if user_stats is None:
+			user_stats = stats[record.username] = UserStats()
+		user_stats.add(record)
+	return stats
+
+
+def summary_filename(path: str) -> str:
+	"""
+	log201901.txt -> log201901.summary.json
+	"""
+	return path.rsplit('.', 1)[0] + ".summary.json"
+
+
+def write_summary(path: str) -> Dict[str, UserStats]:
+	"""
+	Compute statistics for a whole rotated month and store them next to it
+
+	:param path: Path to a rotated log file
+	:return: The statistics
+	"""
+	stats = file_stats(path)
+	summary = {
+		'size': os.stat(path).st_size,
+		'users': {username: user_stats.to_dict() for username, user_stats in stats.items()},
+	}
+	tmp_filename = summary_filename(path) + ".tmp"
+	with open(tmp_filename, "w") as summary_file:
+		json.dump(summary, summary_file)
+	os.replace(tmp_filename, summary_filename(path))
+	return stats
+
+
+def read_summary(path: str) -> Optional[Dict[str, UserStats]]:
+	"""
+	Load the summary for a rotated month
+
+	:param path: Path to a rotated log file
+	:return: The statistics, None if there's no summary or it doesn't match the file anymore
+	"""
+	try:
+		with open(summary_filename(path), "r") as summary_file:
+			summary = json.load(summary_file)
+		if summary['size'] != os.stat(path).st_size:
+			return None
+		return {username: UserStats.from_dict(data) for username, data in summary['users'].items()}
+	except (OSError, ValueError, KeyError, TypeError):
+		return None
+
+
+def write_month(path: str):
+	"""
+	Write archive and summary for a rotated month, the summary is computed from the archive
+	"""
+	write_archive(path)
+	write_summary(path)
+
+
+def rebuild_summaries(log_filename: str) -> int:
+	"""
+	Write archive and summary for every rotated month
+
+	:param log_filename: Path to the current log file
+	:return: How many summaries have been written
+	"""
+	# Importing this costs more than most runs of the program: only when needed
+	from concurrent.futures import ProcessPoolExecutor
+	paths = [path for path, month in log_files(log_filename) if month is not None]
+	with ProcessPoolExecutor() as executor:
+		for _ in executor.map(write_month, paths):
+			pass
+	return len(paths)
+
+
+def _whole_month_in_range(month: Optional[int], since: Optional[datetime], until: Optional[datetime]) -> bool:
+	if month is None:
+		return False
+	year, month = divmod(month, 100)
+	if since is not None and since > datetime(year, month, 1):
+		return False
+	if until is not None:
+		next_month = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+		# --until includes the whole day, up to 23:59:59
+		if until < next_month - timedelta(seconds=1):
+			return False
+	return True
+
+
+def history_stats(log_filename: str, since: Optional[datetime] = None, until: Optional[datetime] = None,
+				  workers: Optional[int] = None, current: bool = True) -> Dict[str, UserStats]:
+	"""
+	Per-user statistics over every log file, in parallel
+
+	:param log_filename: Path to the current log file
+	:param since: Only sessions started from here, None for the beginning of time
+	:param until: Only sessions started up to here, None for now
+	:param workers: How many processes, None for one per CPU
+	:param current: Include the current log file, False for rotated ones only
+	:return: Username -> statistics
+	"""
+	partials = []
+	paths = []
+	for path, month in log_files(log_filename):
+		if month is None and not current:
+			continue
+		if not _month_in_range(month, since, until):
+			continue
+		summary = read_summary(path) if _whole_month_in_range(month, since, until) else None
+		if summary is None:
+			paths.append(path)
+		else:
+			partials.append(summary)
+
+	if len(paths) <= 1:
+		partials.extend(file_stats(path, since, until) for path in paths)
+	else:
+		from concurrent.futures import ProcessPoolExecutor
+		with ProcessPoolExecutor(max_workers=workers) as executor:
+			partials.extend(executor.map(file_stats, paths, [since] * len(paths), [until] * len(paths)))
+
+	total = {}
+	for partial in partials:
+		for username, user_stats in partial.items():
+			if username in total:
+				total[username].merge(user_stats)
+			else:
+				total[username] = user_stats
+	return total
@@ -0,0 +1,155 @@
+"""
+Runs the "first in" and "last out" scripts without making anyone wait for them.
+
+Each trigger forks twice: the intermediate process exits right away and is reaped, so the one left is adopted
+by init and nothing is ever left as a zombie, even if weeelab keeps running. That process:
+
+- drops the trigger if another one for the same event is still waiting to start, since it would do the same thing
+- waits for one of HOOK_CONCURRENCY slots, so a slow script doesn't overlap with the next one
+- checks that the lab is still in the state that triggered it, e.g. nobody came in while "last out" was waiting
+- runs the script in its own session, killing the whole session if it runs longer than HOOK_TIMEOUT
+- appends what happened (duration, exit status) as a line of JSON to HOOKS_LOG_FILENAME
+
+Slots and waiting triggers are flock()s on files next to the log, so this works across processes.
+"""
+
+import fcntl
+import json
+import os
+import signal
+import subprocess
+import sys
+from datetime import datetime
+from time import monotonic, sleep
+from typing import Callable, Optional
+
+from constans import HOOK_CONCURRENCY, HOOK_TIMEOUT, HOOKS_LOG_FILENAME, LOG_PATH
+
+# How long to wait before giving up on a slot
+SLOT_WAIT = 10 * 60
+# How long after SIGTERM before SIGKILL
+KILL_GRACE = 5
+
+
+def trigger(event: str, script: str, still_valid: Callable[[], bool]):
+	"""
+	Run a hook in the background and return immediately
+
+	:param event: first_in or last_out
+	:param script: Path to the script
+	:param still_valid: Called right before starting the script, if it returns False the script is skipped
+	"""
+	sys.stdout.flush()
+	sys.stderr.flush()
+	pid = os.fork()
+	if pid != 0:
+		# The intermediate process exits immediately, collect it now
+		os.waitpid(pid, 0)
+		return
+	try:
+		os.setsid()
+		if os.fork() != 0:
+			os._exit(0)
+		devnull = os.open(os.devnull, os.O_RDWR)
+		for fd in (0, 1, 2):
+			os.dup2(devnull, fd)
+		_supervise(event, script, still_valid)
+	finally:
+		os._exit(0)
+
+
+def _lock_file(name: str) -> int:
+	return os.open(os.path.join(LOG_PATH, name), os.O_RDWR | os.O_CREAT, 0o664)
+
+
+def _try_lock(fd: int) -> bool:
+	try:
+		fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		return True
+	except BlockingIOError:
+		return False
+
+
+def _take_slot() -> Optional[int]:
+	deadline = monotonic() + SLOT_WAIT
+	while monotonic() < deadline:
+		for slot in range(max(HOOK_CONCURRENCY, 1)):
+			fd = _lock_file(f"hooks.slot{slot}.lock")
+			if _try_lock(fd):
+				return fd
+			os.close(fd)
+		sleep(0.1)
+	return None
+
+
+def _supervise(event: str, script: str, still_valid: Callable[[], bool]):
+	started = datetime.now()
+	pending = _lock_file(f"hooks.{event}.pending")
+	if not _try_lock(pending):
+		_record(started, event, script, 'dropped', None, 0)
+		return
+	slot = _take_slot()
+	# From now on another trigger can wait for its turn
+	os.close(pending)
+	if slot is None:
+		_record(started, event, script, 'no slot', None, 0)
+		return
+	try:
+		if still_valid():
+			_run(started, event, script)
+		else:
+			_record(started, event, script, 'skipped', None, 0)
+	finally:
+		os.close(slot)
+
+
+def _run(started: datetime, event: str, script: str):
+	start = monotonic()
+	try:
+		process = subprocess.Popen([script], start_new_session=True, stdin=subprocess.DEVNULL,
+								   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	except OSError:
+		_record(started, event, script, 'not started', None, 0)
+		return
+	try:
+		returncode = process.wait(HOOK_TIMEOUT)
+		status = 'ok' if returncode == 0 else 'failed'
+	except subprocess.TimeoutExpired:
+		status = 'timeout'
+		_kill(process)
+		returncode = process.returncode
+	_record(started, event, script, status, returncode, monotonic() - start)
+
+
+def _kill(process: subprocess.Popen):
+	# The script has its own session, so its children go down with it
+	for sig in (signal.SIGTERM, signal.SIGKILL):
+		try:
+			os.killpg(process.pid, sig)
+		except ProcessLookupError:
+			pass
+		try:
+			process.wait(KILL_GRACE)
+			return
+		except subprocess.TimeoutExpired:
+			pass
+
+
+def _record(started: datetime, event: str, script: str, status: str, returncode: Optional[int], duration: float):
+	record = {
+		'time': started.isoformat(timespec='seconds'),
+		'event': event,
+		'script': script,
+		'status': status,
+		'exit': returncode,
+		'duration_ms': round(duration * 1000, 1),
+	}
+	try:
+		fd = os.open(HOOKS_LOG_FILENAME, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+		try:
+			os.write(fd, (json.dumps(record) + "\n").encode('utf-8'))
+		finally:
+			os.close(fd)
+	except OSError:
+		# Nowhere to complain, stdout and stderr are gone
+		pass
@@ -0,0 +1,161 @@
+"""
+Write-ahead journal for changes to the log.
+
+Every change is first described in log.journal and synced to disk, then applied to the log, then the
+journal is removed. If the power goes away halfway, the journal is still there on the next run and its
+changes are applied again: every kind of change gives the same result no matter how many times it's
+applied. Many changes can go in the same journal, so syncing is paid once for all of them.
+
+Changes are dicts with an 'op' key:
+
+- append: {'offset': where the line starts, 'line': the line}
+- close: {'offset': start of the [INLAB] line, 'logout': "dd/mm/YYYY HH:MM", 'duration': "HH:MM",
+  'message': work done, 'end': end of the line (after its newline, if any) to append the message there,
+  None to use the companion file}
+- rotate: {'stored': path of the rotated log}
+"""
+
+import json
+import os
+from typing import Iterable, List, Set
+
+from messages import append_message, messages_filename
+from timing import span
+
+
+def journal_filename(log_filename: str) -> str:
+	"""
+	log.txt -> log.journal
+	"""
+	return log_filename.rsplit('.', 1)[0] + ".journal"
+
+
+def _fsync_dir(path: str):
+	fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+
+def _fsync_file(path: str):
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+
+def replace_file(filename: str, chunks: Iterable[bytes]):
+	"""
+	Atomically replace a file: write a temporary one, sync it and rename it over the old one
+
+	:param filename: File to replace
+	:param chunks: New content
+	"""
+	tmp_filename = filename + ".tmp"
+	with open(tmp_filename, "wb") as tmp_file:
+		for chunk in chunks:
+			tmp_file.write(chunk)
+		tmp_file.flush()
+		os.fsync(tmp_file.fileno())
+	os.replace(tmp_filename, filename)
+	_fsync_dir(filename)
+
+
+def commit(log_filename: str, changes: List[dict]):
+	"""
+	Apply changes to the log, surviving crashes. Hold the log lock while calling this.
+
+	:param log_filename: Path to log file
+	:param changes: What to do, in order
+	"""
+	if len(changes) == 0:
+		return
+	with span("journal.commit"):
+		filename = journal_filename(log_filename)
+		replace_file(filename, [json.dumps(changes).encode('utf-8')])
+		_apply(log_filename, changes)
+		os.remove(filename)
+		_fsync_dir(filename)
+
+
+def recover(log_filename: str) -> bool:
+	"""
+	Apply changes left behind by a crash, if any. Hold the log lock while calling this.
+
+	:param log_filename: Path to log file
+	:return: True if something had to be recovered
+	"""
+	filename = journal_filename(log_filename)
+	try:
+		with open(filename, "r") as journal_file:
+			changes = json.load(journal_file)
+	except FileNotFoundError:
+		return False
+	except ValueError:
+		# Since it's renamed into place after syncing, this shouldn't happen. But if it does,
+		# the journal wasn't complete and nothing has been applied yet.
+		os.remove(filename)
+		return False
+	_apply(log_filename, changes)
+	os.remove(filename)
+	_fsync_dir(filename)
+	return True
+
+
+def _apply(log_filename: str, changes: List[dict]):
+	touched: Set[str] = set()
+	for change in changes:
+		op = change['op']
+		if op == 'append':
+			_apply_append(log_filename, change)
+			touched.add(log_filename)
+		elif op == 'close':
+			if _apply_close(log_filename, change):
+				touched.add(messages_filename(log_filename))
+			touched.add(log_filename)
+		elif op == 'rotate':
+			_apply_rotate(log_filename, change)
+		else:
+			raise ValueError(f"Unknown journal operation {op}")
+	for path in touched:
+		_fsync_file(path)
+
+
+def _apply_append(log_filename: str, change: dict):
+	# Not opened in append mode: after a crash the line may be there already, or half of it
+	with open(log_filename, "r+b") as log_file:
+		log_file.seek(change['offset'])
+		log_file.write(change['line'].encode('utf-8'))
+
+
+def _apply_close(log_filename: str, change: dict) -> bool:
+	offset = change['offset']
+	with open(log_filename, "r+b") as log_file:
+		log_file.seek(offset + 20)
+		log_file.write(change['logout'].encode('utf-8'))
+		log_file.seek(offset + 39)
+		log_file.write(change['duration'].encode('utf-8'))
+		if change['end'] is not None:
+			# The message goes over the newline, or right after the ">" if the line has none (e.g. edited by hand).
+			# After the first time the byte is a space, so applying it again writes in the same place.
+			log_file.seek(change['end'] - 1)
+			if log_file.read(1) != b">":
+				log_file.seek(change['end'] - 1)
+			log_file.write(f" :: {change['message']}\n".encode('utf-8'))
+			return False
+	# Applying this twice leaves a duplicate record, which is harmless: the last one wins when reading
+	append_message(log_filename, offset, change['message'])
+	return True
+
+
+def _apply_rotate(log_filename: str, change: dict):
+	stored = change['stored']
+	if os.path.exists(log_filename) and not os.path.exists(stored):
+		os.rename(log_filename, stored)
+	if os.path.exists(messages_filename(log_filename)) and not os.path.exists(messages_filename(stored)):
+		os.rename(messages_filename(log_filename), messages_filename(stored))
+	if not os.path.exists(log_filename):
+		open(log_filename, "a").close()
+	_fsync_dir(log_filename)
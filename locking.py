@@ -0,0 +1,118 @@
+"""
+Advisory locking for the log, shared by every weeelab instance (and anything else that plays along).
+
+The lock is an flock() on log.txt.lock: the kernel releases it when the process dies, so a crash can't
+leave the log locked forever. The lock file itself is never removed.
+"""
+
+import fcntl
+import os
+from contextlib import contextmanager
+from time import monotonic, sleep
+from typing import Dict, Optional
+
+from timing import span
+
+
+class LockTimeoutError(BaseException):
+	def __init__(self):
+		pass
+
+
+# lock filename -> (file descriptor, how many times it's been taken), to make the lock reentrant
+_held: Dict[str, list] = {}
+
+
+def lock_filename(log_filename: str) -> str:
+	return log_filename + ".lock"
+
+
+def holds_lock(log_filename: str) -> bool:
+	"""
+	:return: True if this process is holding the lock on a log file
+	"""
+	return lock_filename(log_filename) in _held
+
+
+@contextmanager
+def log_lock(log_filename: str, timeout: Optional[float] = None):
+	"""
+	Hold the exclusive lock on a log file for the duration of the with block.
+	Taking it again while already held by this process is fine.
+
+	:param log_filename: Path to log file
+	:param timeout: Seconds to wait before raising LockTimeoutError, None to wait forever
+	"""
+	filename = lock_filename(log_filename)
+	held = _held.get(filename)
+	if held is not None:
+		held[1] += 1
+		try:
+			yield
+		finally:
+			held[1] -= 1
+		return
+
+	fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o664)
+	try:
+		with span("lock.wait"):
+			_acquire(fd, timeout)
+	except BaseException:
+		os.close(fd)
+		raise
+	_held[filename] = [fd, 1]
+	try:
+		yield
+	finally:
+		del _held[filename]
+		# Closing the file releases the lock
+		os.close(fd)
+
+
+@contextmanager
+def try_log_lock(log_filename: str):
+	"""
+	Like log_lock, but never waits: the with block gets False if someone else is holding the lock
+
+	:param log_filename: Path to log file
+	"""
+	filename = lock_filename(log_filename)
+	if filename in _held:
+		with log_lock(log_filename):
+			yield True
+		return
+
+	fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o664)
+	try:
+		fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except BlockingIOError:
+		os.close(fd)
+		yield False
+		return
+	_held[filename] = [fd, 1]
+	try:
+		yield True
+	finally:
+		del _held[filename]
+		os.close(fd)
+
+
+def _acquire(fd: int, timeout: Optional[float]):
+	if timeout is None:
+		fcntl.flock(fd, fcntl.LOCK_EX)
+		return
+	# flock can't time out by itself: poll, starting fast since locks are usually held for a few ms
+	deadline = monotonic() + timeout
+	delay = 0.001
+	while True:
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			return
+		except BlockingIOError:
+			pass
+		remaining = deadline - monotonic()
+		if remaining <= 0:
+			print(f"Someone else is holding the lock on the log file, try again later")
+			raise LockTimeoutError
+		sleep(min(delay, remaining))
+		delay = min(delay * 2, 0.05)
@@ -0,0 +1,183 @@
+"""
+The one place that knows how log lines are made.
+
+[02/05/2017 10:00] [----------------] [INLAB] <username>
+[02/05/2017 10:00] [02/05/2017 12:30] [02:30] <username> :: what has been done
+
+Lines become LogRecord objects, a whole file can be read as a lazy stream of them. To show the log as it is, lines
+can also be read as they are, from the start or from the end, each with its record. Messages stored in the companion
+file (see messages.py) are merged back into their records and lines.
+"""
+
+from datetime import datetime
+from typing import Iterator, Optional, Tuple
+
+from backwards import lines_backwards
+from messages import MessageFinder, read_messages
+
+OPEN_PLACEHOLDER = b"----------------"
+
+
+class LogRecord:
+	"""
+	A session: logout, duration and message are None while the user is still in lab
+	"""
+	__slots__ = ('login', 'logout', 'duration', 'username', 'message', 'offset')
+
+	def __init__(self, login: datetime, logout: Optional[datetime], duration: Optional[int], username: str,
+				 message: Optional[str], offset: int):
+		self.login = login
+		self.logout = logout
+		# minutes
+		self.duration = duration
+		self.username = username
+		self.message = message
+		# byte offset of the line in the log file
+		self.offset = offset
+
+	@property
+	def inlab(self) -> bool:
+		return self.logout is None
+
+	def __str__(self):
+		"""
+		The line as it would be written in the log, without newline
+		"""
+		login = self.login.strftime("%d/%m/%Y %H:%M")
+		if self.inlab:
+			return f"[{login}] [----------------] [INLAB] <{self.username}>"
+		line = f"[{login}] [{self.logout.strftime('%d/%m/%Y %H:%M')}] [{format_duration(self.duration)}] <{self.username}>"
+		if self.message is not None:
+			line += f" :: {self.message}"
+		return line
+
+
+def format_duration(minutes: int) -> str:
+	"""
+	Minutes as HH:MM, like in the log
+	"""
+	sign = "-" if minutes < 0 else ""
+	minutes = abs(minutes)
+	return f"{sign}{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def _parse_timestamp(line: bytes, start: int) -> datetime:
+	# dd/mm/YYYY HH:MM, int() takes bytes directly and that's way faster than strptime
+	return datetime(
+		int(line[start + 6:start + 10]),
+		int(line[start + 3:start + 5]),
+		int(line[start:start + 2]),
+		int(line[start + 11:start + 13]),
+		int(line[start + 14:start + 16])
+	)
+
+
+def parse_duration(field: bytes) -> int:
+	"""
+	HH:MM from the log to minutes
+	"""
+	hours, minutes = field.split(b":", 1)
+	if hours.startswith(b"-"):
+		return int(hours) * 60 - int(minutes)
+	return int(hours) * 60 + int(minutes)
+
+
+def parse_line(line: bytes, offset: int = 0) -> Optional[LogRecord]:
+	"""
+	Turn a raw line into a record
+
+	:param line: Line from the log, with or without newline
+	:param offset: Where the line starts in the file
+	:return: The record, None for blank or malformed lines
+	"""
+	try:
+		# Duration is usually 5 characters, but not always: find where it ends
+		closed = line.index(b"]", 39)
+		user_start = closed + 3
+		user_end = line.index(b">", user_start)
+		username = line[user_start:user_end].decode('utf-8')
+		login = _parse_timestamp(line, 1)
+		if line[20:36] == OPEN_PLACEHOLDER:
+			return LogRecord(login, None, None, username, None, offset)
+		logout = _parse_timestamp(line, 20)
+		duration = parse_duration(line[39:closed])
+	except ValueError:
+		return None
+	message_start = user_end + 5
+	if line[user_end + 1:message_start] == b" :: ":
+		message = line[message_start:].rstrip(b"\n").decode('utf-8')
+	else:
+		message = None
+	return LogRecord(login, logout, duration, username, message, offset)
+
+
+def iter_records(log_filename: str, start: int = 0) -> Iterator[LogRecord]:
+	"""
+	Stream every record from a log file, one line at a time
+
+	:param log_filename: Path to log file
+	:param start: Byte offset to start from, must be the beginning of a line
+	:return: Records, in file order
+	"""
+	messages = read_messages(log_filename)
+	offset = start
+	with open(log_filename, "rb") as log_file:
+		log_file.seek(start)
+		for line in log_file:
+			record = parse_line(line, offset)
+			offset += len(line)
+			if record is None:
+				continue
+			if record.message is None and record.offset in messages:
+				record.message = messages[record.offset]
+			yield record
+
+
+def _with_message(line: bytes, record: Optional[LogRecord], message: Optional[str]) -> str:
+	"""
+	The line as it is in the file, without newline, plus its message if it's in the companion file
+	"""
+	text = line.rstrip(b"\n").decode('utf-8', errors='replace')
+	if message is None:
+		return text
+	record.message = message
+	return f"{text} :: {message}"
+
+
+def iter_lines(log_filename: str) -> Iterator[Tuple[str, Optional[LogRecord]]]:
+	"""
+	Stream every line of a log file as it is, even those that can't be parsed
+
+	:param log_filename: Path to log file
+	:return: Line (without newline, with its message) and record, None if the line isn't a session; in file order
+	"""
+	messages = read_messages(log_filename)
+	offset = 0
+	with open(log_filename, "rb") as log_file:
+		for line in log_file:
+			record = parse_line(line, offset)
+			message = None
+			if record is not None and record.message is None and not record.inlab:
+				message = messages.get(offset)
+			offset += len(line)
+			yield _with_message(line, record, message), record
+
+
+def iter_lines_backwards(log_filename: str) -> Iterator[Tuple[str, Optional[LogRecord]]]:
+	"""
+	Stream every line of a log file as it is, from the last one to the first, reading only as much as needed
+
+	:param log_filename: Path to log file
+	:return: Line (without newline, with its message) and record, None if the line isn't a session; in reverse
+		file order
+	"""
+	messages = MessageFinder(log_filename)
+	try:
+		for offset, line in lines_backwards(log_filename):
+			record = parse_line(line, offset)
+			message = None
+			if record is not None and record.message is None and not record.inlab:
+				message = messages.get(offset)
+			yield _with_message(line, record, message), record
+	finally:
+		messages.close()
@@ -0,0 +1,89 @@
+"""
+Companion file for logout messages.
+
+Closing a session patches the fixed-width fields of its [INLAB] line in place, but the ":: workdone"
+part doesn't fit there. Unless the line is the last one in the log (then it's just appended), the
+message goes to this append-only file instead, one "offset message" record per line, where offset is
+the byte offset of the line it belongs to in the log.
+"""
+
+import os
+from typing import Dict, Optional
+
+from backwards import lines_backwards
+
+
+def messages_filename(log_filename: str) -> str:
+	"""
+	Where the messages for a log file live: log.txt -> log.messages.txt, log201901.txt -> log201901.messages.txt
+
+	:param log_filename: Path to log file
+	:return: Path to companion file
+	"""
+	return log_filename.rsplit('.', 1)[0] + ".messages.txt"
+
+
+def append_message(log_filename: str, offset: int, message: str):
+	"""
+	Record the logout message for the line at some offset.
+
+	:param log_filename: Path to log file
+	:param offset: Byte offset of the line in the log
+	:param message: Work done
+	"""
+	record = f"{offset} {message.replace(chr(10), ' ')}\n"
+	with open(messages_filename(log_filename), "ab") as messages_file:
+		messages_file.write(record.encode('utf-8'))
+
+
+def read_messages(log_filename: str) -> Dict[int, str]:
+	"""
+	Load all the messages for a log file.
+
+	:param log_filename: Path to log file
+	:return: Byte offset of the line -> message, empty if there's no companion file
+	"""
+	messages = {}
+	filename = messages_filename(log_filename)
+	if not os.path.exists(filename):
+		return messages
+	with open(filename, "rb") as messages_file:
+		for record in messages_file:
+			offset, message = record.rstrip(b"\n").split(b" ", 1)
+			messages[int(offset)] = message.decode('utf-8')
+	return messages
+
+
+class MessageFinder:
+	"""
+	Messages looked up one at a time, newest lines first. The companion file is read backwards and only as far
+	as needed: messages are appended when sessions are closed, so the ones for the last lines are near its end.
+	"""
+
+	def __init__(self, log_filename: str):
+		filename = messages_filename(log_filename)
+		self._records = lines_backwards(filename) if os.path.exists(filename) else None
+		self._found: Dict[int, str] = {}
+
+	def get(self, offset: int) -> Optional[str]:
+		"""
+		:param offset: Byte offset of the line in the log
+		:return: Its message, None if there's none
+		"""
+		while offset not in self._found:
+			if self._records is None:
+				return None
+			try:
+				position, record = next(self._records)
+			except StopIteration:
+				self._records = None
+				return None
+			record_offset, message = record.rstrip(b"\n").split(b" ", 1)
+			# Reading backwards, the first one seen is the last one written
+			self._found.setdefault(int(record_offset), message.decode('utf-8'))
+		return self._found[offset]
+
+	def close(self):
+		if self._records is not None:
+			self._records.close()
+			self._records = None
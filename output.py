@@ -0,0 +1,102 @@
+"""
+Output for other programs: rows (dicts with the same keys) written as JSON, NDJSON or CSV.
+
+Rows come from a generator and are written as they arrive, so memory doesn't grow with the log, and they go through
+a buffer instead of one write per line. Times are ISO 8601, durations are minutes, missing values are null
+(an empty field in CSV).
+"""
+
+import csv
+import io
+import json
+import os
+import sys
+from datetime import datetime
+from typing import Iterable, List
+
+FORMATS = ('text', 'json', 'ndjson', 'csv')
+
+
+def iso(when) -> str:
+	"""
+	datetime or date as ISO 8601, down to the minute, None stays None
+	"""
+	if when is None:
+		return None
+	if isinstance(when, datetime):
+		return when.isoformat(timespec='minutes')
+	return when.isoformat()
+
+
+class _Buffered:
+	"""
+	Text stream on top of stdout's binary buffer, for the duration of a with block: text is encoded and
+	written in big chunks instead of line by line, even on a terminal
+	"""
+
+	def __enter__(self) -> io.TextIOBase:
+		sys.stdout.flush()
+		if hasattr(sys.stdout, 'buffer'):
+			self.stream = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', newline='')
+		else:
+			# Already in memory (e.g. the daemon collecting output), nothing to gain
+			self.stream = None
+			return sys.stdout
+		return self.stream
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		if self.stream is None:
+			return False
+		try:
+			if exc_type is None:
+				self.stream.flush()
+				self.stream.buffer.flush()
+		except BrokenPipeError:
+			exc_type = BrokenPipeError
+		if exc_type is BrokenPipeError:
+			# e.g. | head: there's no one left to read the rest, and Python shouldn't complain about it when exiting
+			os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+			return True
+		# Without closing stdout
+		self.stream.detach()
+		return False
+
+
+def write_rows(rows: Iterable[dict], fmt: str, fields: List[str]):
+	"""
+	Write rows to stdout
+
+	:param rows: The rows, each with the keys in fields
+	:param fmt: json (a single array), ndjson (one object per line) or csv (with a header)
+	:param fields: Keys of the rows, in order
+	"""
+	with _Buffered() as stream:
+		if fmt == 'csv':
+			writer = csv.DictWriter(stream, fields, lineterminator="\n")
+			writer.writeheader()
+			writer.writerows(rows)
+		elif fmt == 'ndjson':
+			for row in rows:
+				stream.write(json.dumps(row, ensure_ascii=False))
+				stream.write("\n")
+		elif fmt == 'json':
+			separator = "[\n"
+			for row in rows:
+				stream.write(separator)
+				stream.write(json.dumps(row, ensure_ascii=False))
+				separator = ",\n"
+			stream.write("[]\n" if separator == "[\n" else "\n]\n")
+		else:
+			raise ValueError(f"Unknown format {fmt}")
+
+
+def write_lines(lines: Iterable[str]):
+	"""
+	Write lines of text to stdout, through the same buffer
+
+	:param lines: The lines, without newline
+	"""
+	with _Buffered() as stream:
+		for line in lines:
+			stream.write(line)
+			stream.write("\n")
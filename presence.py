@@ -0,0 +1,209 @@
+"""
+Presence index: who is in lab right now and how long everyone has been there this month,
+without reading the whole log every time.
+
+Lines before the oldest open [INLAB] one never change again: that point is a checkpoint. The index
+stores it, along with the minutes of every session closed before it, the open sessions (username and
+byte offset of their line) and inode and size of the log. When the log changes, only the part after
+the checkpoint is parsed again, so anything appended by other tools is picked up cheaply. If the log
+has been replaced (rotated, edited by hand) or shrunk, everything starts again from byte zero.
+
+The index lives in a small JSON file next to the log. Only who holds the log lock writes it: anyone else
+(-p, --watch, the daemon answering -p...) brings its own copy up to date in memory, and saves it only if the lock
+happens to be free and the log hasn't changed since it was read.
+"""
+
+import json
+import os
+from typing import Dict, List, Optional
+
+from atomic import replace_json
+from locking import holds_lock, try_log_lock
+from logparse import parse_line
+from timing import span
+
+
+def index_filename(log_filename: str) -> str:
+	"""
+	Where the index for a log file lives: log.txt -> log.inlab.json
+
+	:param log_filename: Path to log file
+	:return: Path to index file
+	"""
+	return log_filename.rsplit('.', 1)[0] + ".inlab.json"
+
+
+def log_stamp(log_filename: str) -> List[int]:
+	stat = os.stat(log_filename)
+	return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+class PresenceIndex:
+	def __init__(self, log_filename: str):
+		self.log_filename = log_filename
+		self.filename = index_filename(log_filename)
+		# username -> byte offset of its [INLAB] line
+		self.users: Dict[str, int] = {}
+		# every line before this offset is closed and accounted for in self.closed
+		self.checkpoint = 0
+		# username -> minutes, sessions before the checkpoint
+		self.closed: Dict[str, int] = {}
+		# username -> minutes, closed sessions after the checkpoint
+		self.tail: Dict[str, int] = {}
+		self._stamp = None
+
+	def load(self, persist: bool = True):
+		"""
+		Make the index match the log: reuse the in-memory copy if still valid, otherwise take
+		the one on disk and parse whatever has changed after its checkpoint.
+
+		:param persist: Save the result for other processes if possible, False to keep it in memory only
+		"""
+		stamp = log_stamp(self.log_filename)
+		if stamp == self._stamp:
+			return
+		if self._stamp is None:
+			with span("presence.read"):
+				self._read()
+		if self._stamp == stamp:
+			return
+		# Not the same file anymore, or truncated: the checkpoint means nothing
+		if self._stamp is None or self._stamp[2] != stamp[2] or stamp[0] < self.checkpoint:
+			self.reset()
+		with span("log.scan"):
+			end = self._advance(stamp[0])
+		# What has been read, not what the log looks like now: someone may be writing it if the lock isn't held
+		self._stamp = [end, stamp[1], stamp[2]]
+		self._settle()
+		if not persist:
+			return
+		if holds_lock(self.log_filename):
+			self._write()
+			return
+		# Save the work for the next process, but only if nobody is writing the log and it's still what was read
+		with try_log_lock(self.log_filename) as locked:
+			if locked and log_stamp(self.log_filename) == self._stamp:
+				self._write()
+
+	def _read(self):
+		try:
+			with open(self.filename, "r") as index_file:
+				data = json.load(index_file)
+			self.users = {username: int(offset) for username, offset in data['users'].items()}
+			self.checkpoint = int(data['checkpoint'])
+			self.closed = data['closed']
+			self.tail = data['tail']
+			self._stamp = data['log']
+		except (OSError, ValueError, KeyError, TypeError, AttributeError):
+			self.reset()
+
+	def reset(self):
+		"""
+		Forget everything, next load() will parse the log from the beginning
+		"""
+		self.users = {}
+		self.checkpoint = 0
+		self.closed = {}
+		self.tail = {}
+		self._stamp = None
+
+	def _advance(self, size: int) -> int:
+		"""
+		Parse the log from the checkpoint up to some size
+
+		:param size: Where to stop, size of the log when it was stamped
+		:return: Where it stopped: before a line still being written, if any
+		"""
+		users = {}
+		tail = {}
+		checkpoint = self.checkpoint
+		offset = self.checkpoint
+		with open(self.log_filename, "rb") as log_file:
+			log_file.seek(offset)
+			for line in log_file:
+				if offset + len(line) > size:
+					# Written after the stamp was taken, next time
+					break
+				record = parse_line(line, offset)
+				if record is None and not line.endswith(b"\n"):
+					# Half a line: someone is appending it right now
+					break
+				offset += len(line)
+				if record is None:
+					pass
+				elif record.inlab:
+					users[record.username] = record.offset
+				elif len(users) == 0:
+					# Nobody in lab before this line: it's final, move the checkpoint past it
+					self.closed[record.username] = self.closed.get(record.username, 0) + record.duration
+				else:
+					tail[record.username] = tail.get(record.username, 0) + record.duration
+				if len(users) == 0:
+					checkpoint = offset
+		self.users = users
+		self.tail = tail
+		self.checkpoint = checkpoint
+		return offset
+
+	def _settle(self):
+		if len(self.users) == 0:
+			# Everyone logged out, nothing in the file can change anymore
+			for username, minutes in self.tail.items():
+				self.closed[username] = self.closed.get(username, 0) + minutes
+			self.tail = {}
+			self.checkpoint = self._stamp[0]
+
+	def save(self):
+		"""
+		Write the index to disk. Call this right after changing the log, while holding the lock, so it gets the new stamp.
+		"""
+		self._stamp = log_stamp(self.log_filename)
+		self._settle()
+		self._write()
+
+	def _write(self):
+		replace_json(self.filename, {
+			'log': self._stamp,
+			'checkpoint': self.checkpoint,
+			'users': self.users,
+			'closed': self.closed,
+			'tail': self.tail,
+		})
+
+	def is_in(self, username: str) -> bool:
+		return username in self.users
+
+	def count(self) -> int:
+		return len(self.users)
+
+	def usernames(self) -> List[str]:
+		"""
+		:return: Users in lab, in the same order as their lines in the log
+		"""
+		return sorted(self.users, key=self.users.get)
+
+	def offset(self, username: str) -> Optional[int]:
+		return self.users.get(username)
+
+	def minutes(self) -> Dict[str, int]:
+		"""
+		:return: Username -> minutes, for sessions closed in this log
+		"""
+		minutes = dict(self.closed)
+		for username, tail_minutes in self.tail.items():
+			minutes[username] = minutes.get(username, 0) + tail_minutes
+		return minutes
+
+	def add(self, username: str, offset: int):
+		self.users[username] = offset
+
+	def remove(self, username: str, minutes: int):
+		"""
+		Drop a user that has logged out.
+
+		:param username: Who logged out
+		:param minutes: Duration of the session
+		"""
+		del self.users[username]
+		# Still after the checkpoint, the next _advance() will count it again from the log
+		self.tail[username] = self.tail.get(username, 0) + minutes
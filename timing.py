@@ -0,0 +1,130 @@
+"""
+Where does the time go? Spans around the slow phases (LDAP, lock waits, log scanning, hooks...).
+
+Nothing is recorded until enable() is called, so spans cost next to nothing in normal runs.
+At the end of a run the spans can be printed (--profile) or appended as one JSON line to a metrics file,
+to look at percentiles over a long period.
+"""
+
+import json
+import os
+from contextlib import contextmanager
+from datetime import datetime
+from time import perf_counter
+from typing import Dict, List, Optional
+
+_enabled = False
+_start: Optional[float] = None
+# name, seconds: in the order they ended, nested spans before the span containing them
+_spans: List[list] = []
+
+
+def enable():
+	global _enabled, _start
+	_enabled = True
+	_start = perf_counter()
+	_spans.clear()
+
+
+def disable():
+	global _enabled
+	_enabled = False
+
+
+def enabled() -> bool:
+	return _enabled
+
+
+@contextmanager
+def span(name: str):
+	"""
+	Time the with block, if timing is enabled
+
+	:param name: Phase name, like "ldap.search": same name, same row in the report
+	"""
+	if not _enabled:
+		yield
+		return
+	start = perf_counter()
+	try:
+		yield
+	finally:
+		_spans.append([name, perf_counter() - start])
+
+
+def spans() -> List[list]:
+	"""
+	:return: [name, seconds] for everything recorded since enable()
+	"""
+	return list(_spans)
+
+
+def add_spans(others: List[list], prefix: str = ""):
+	"""
+	Add spans recorded somewhere else, e.g. by the daemon
+
+	:param others: [name, seconds] pairs
+	:param prefix: Prepended to their names
+	"""
+	if _enabled:
+		_spans.extend([prefix + name, seconds] for name, seconds in others)
+
+
+def elapsed() -> float:
+	"""
+	:return: Seconds since enable()
+	"""
+	return perf_counter() - _start
+
+
+def totals() -> Dict[str, List[float]]:
+	"""
+	:return: Phase name -> [how many times, seconds], in order of first appearance
+	"""
+	result = {}
+	for name, seconds in _spans:
+		if name in result:
+			result[name][0] += 1
+			result[name][1] += seconds
+		else:
+			result[name] = [1, seconds]
+	return result
+
+
+def print_report():
+	total = elapsed()
+	print(f"Profile, {total * 1000:.1f} ms in total:")
+	phases = totals()
+	if len(phases) == 0:
+		print(f"  nothing slow happened")
+		return
+	width = max(len(name) for name in phases)
+	for name, (count, seconds) in phases.items():
+		share = seconds / total * 100 if total > 0 else 0
+		print(f"  {name.ljust(width)}  {seconds * 1000:9.1f} ms  {share:5.1f}%  x{count}")
+
+
+def append_metrics(metrics_filename: str, action: str, result: bool):
+	"""
+	Append timings for this run to a file, as a line of JSON
+
+	:param metrics_filename: Where
+	:param action: What has been done, e.g. "login"
+	:param result: Whether it succeeded
+	"""
+	record = {
+		'time': datetime.now().isoformat(timespec='seconds'),
+		'action': action,
+		'result': result,
+		'total_ms': round(elapsed() * 1000, 3),
+		'spans': {name: round(seconds * 1000, 3) for name, (count, seconds) in totals().items()},
+	}
+	try:
+		# A single write of a short line in append mode: lines from concurrent runs don't get mixed up
+		fd = os.open(metrics_filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+		try:
+			os.write(fd, (json.dumps(record) + "\n").encode('utf-8'))
+		finally:
+			os.close(fd)
+	except OSError as e:
+		print(f"Cannot write metrics to {metrics_filename}: {e.strerror}")
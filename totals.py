@@ -0,0 +1,74 @@
+"""
+Total minutes in lab for every user, since the beginning of time.
+
+Rotated months are summed once and cached in a file next to the log (log.totals.json), until the set of
+rotated files changes. The current month comes from the presence index, which keeps it up to date
+incrementally.
+"""
+
+import json
+import os
+from typing import Dict, List
+
+from atomic import replace_json
+from history import history_stats, log_files
+from timing import span
+
+
+def totals_filename(log_filename: str) -> str:
+	"""
+	log.txt -> log.totals.json
+	"""
+	return log_filename.rsplit('.', 1)[0] + ".totals.json"
+
+
+def _archive_stamp(log_filename: str) -> List[list]:
+	return [[os.path.basename(path), os.stat(path).st_size] for path, month in log_files(log_filename) if month is not None]
+
+
+class TotalsCache:
+	def __init__(self, log_filename: str):
+		self.log_filename = log_filename
+		self.filename = totals_filename(log_filename)
+		# username -> minutes, rotated logs only
+		self.archived: Dict[str, int] = {}
+		self._archive_stamp = None
+
+	def load(self):
+		"""
+		Make the totals match the rotated log files, recomputing them only if they changed
+		"""
+		archive_stamp = _archive_stamp(self.log_filename)
+		if archive_stamp == self._archive_stamp:
+			return
+		if self._archive_stamp is None:
+			try:
+				with open(self.filename, "r") as totals_file:
+					data = json.load(totals_file)
+				self.archived = data['archived']
+				self._archive_stamp = data['archive_stamp']
+			except (OSError, ValueError, KeyError, TypeError):
+				pass
+		if archive_stamp != self._archive_stamp:
+			with span("history"):
+				stats = history_stats(self.log_filename, current=False)
+			self.archived = {username: user_stats.minutes for username, user_stats in stats.items()}
+			self._archive_stamp = archive_stamp
+			self.save()
+
+	def save(self):
+		# Readers (--totals, tot_work_time) save too, without the log lock: each one writes its own file
+		replace_json(self.filename, {
+			'archive_stamp': self._archive_stamp,
+			'archived': self.archived,
+		})
+
+	def totals(self, current: Dict[str, int]) -> Dict[str, int]:
+		"""
+		:param current: Username -> minutes in the current log
+		:return: Username -> minutes, over all log files
+		"""
+		totals = dict(self.archived)
+		for username, minutes in current.items():
+			totals[username] = totals.get(username, 0) + minutes
+		return totals
@@ -1,3 +1,12 @@
+import atexit
+from typing import Dict, Iterable, Optional
+
+# ldap is imported only where needed: it's slow to load and --no-ldap doesn't need it at all
+from constans import *
+from usercache import CachedUser, UserCache
+from timing import span
+
+
 # A perfect candidate for dataclasses... which may not be available on an old Python version.
 # So no dataclasses.
 class User:
@@ -17,58 +26,315 @@ class UserNotFoundError(BaseException):
 	def __init__(self):
 		pass
 
+
+def matricolize(username: str):
+	"""
+	Take a username and turn it in a matricole number
+
+	:param username: of the user
+	:return matricole: number
+	"""
+	if username.isdigit():
+		return f"s{username}"
+
+	if username[1:].isdigit() and username[0] in ('s', 'S', 'd', 'D'):
+		return username
+	return None
+
+
+class LdapConnection:
+	"""
+	A connection to the LDAP server, bound once and then reused for every search.
+	If the server drops it, it's opened again transparently.
+	"""
+	def __init__(self, server: str, bind_dn: str, password: str):
+		self.server = server
+		self.bind_dn = bind_dn
+		self.password = password
+		self._conn = None
+
+	def _connect(self):
+		import ldap
+		with span("ldap.bind"):
+			try:
+				# print(f"Asking {LDAP_SERVER} for info...")
+				conn = ldap.initialize(self.server)
+				conn.protocol_version = ldap.VERSION3
+				if self.server.startswith('ldap://'):
+					conn.start_tls_s()
+				conn.simple_bind_s(self.bind_dn, self.password)
+			except ldap.SERVER_DOWN:
+				print(f"Cannot connect to LDAP server {self.server}")
+				raise LdapError
+			if conn is None:
+				print(f"Error connecting to LDAP server :(")
+				raise LdapError
+			self._conn = conn
+
+	def search(self, base: str, the_filter: str, attributes: tuple) -> list:
+		"""
+		Subtree search, reconnecting once if the connection went away
+
+		:param base: Search base DN
+		:param the_filter: LDAP filter
+		:param attributes: Attributes to fetch
+		:return: Results, as returned by search_s
+		"""
+		import ldap
+		if self._conn is None:
+			self._connect()
+		try:
+			with span("ldap.search"):
+				return self._conn.search_s(base, ldap.SCOPE_SUBTREE, the_filter, attributes)
+		except ldap.SERVER_DOWN:
+			self.close()
+		self._connect()
+		try:
+			with span("ldap.search"):
+				return self._conn.search_s(base, ldap.SCOPE_SUBTREE, the_filter, attributes)
+		except ldap.SERVER_DOWN:
+			self.close()
+			print(f"Lost connection to LDAP server {self.server}")
+			raise LdapError
+
+	def search_paged(self, base: str, the_filter: str, attributes: tuple, page_size: int = 500) -> list:
+		"""
+		Subtree search for lots of entries, fetched with the simple paged results control
+
+		:param base: Search base DN
+		:param the_filter: LDAP filter
+		:param attributes: Attributes to fetch
+		:param page_size: Entries per page
+		:return: All the results
+		"""
+		import ldap
+		from ldap.controls import SimplePagedResultsControl
+		if self._conn is None:
+			self._connect()
+		control = SimplePagedResultsControl(True, size=page_size, cookie='')
+		results = []
+		try:
+			while True:
+				with span("ldap.search"):
+					msgid = self._conn.search_ext(base, ldap.SCOPE_SUBTREE, the_filter, attributes, serverctrls=[control])
+					_, data, _, server_controls = self._conn.result3(msgid)
+				results.extend(data)
+				cookies = [c.cookie for c in server_controls if c.controlType == SimplePagedResultsControl.controlType]
+				if not cookies or not cookies[0]:
+					return results
+				control.cookie = cookies[0]
+		except ldap.SERVER_DOWN:
+			self.close()
+			print(f"Lost connection to LDAP server {self.server}")
+			raise LdapError
+
+	def close(self):
+		import ldap
+		if self._conn is not None:
+			try:
+				self._conn.unbind_s()
+			except ldap.LDAPError:
+				pass
+			self._conn = None
+
+
+def get_connection() -> LdapConnection:
+	"""
+	Get the shared LDAP connection, bound on first use and unbound at exit
+	"""
+	global _connection
+	if _connection is None:
+		_connection = LdapConnection(LDAP_SERVER, LDAP_BIND_DN, LDAP_PASSWORD)
+		atexit.register(_connection.close)
+	return _connection
+
+
+_connection = None
+
+
+def get_cache() -> UserCache:
+	global _cache
+	if _cache is None:
+		_cache = UserCache(USER_CACHE_FILENAME, USER_CACHE_TTL, USER_CACHE_MAX)
+	return _cache
+
+
+_cache = None
+
+_ATTRIBUTES = (
+	'uid',
+	'cn',
+	'givenname',
+	'signedsir',
+	'weeelabnickname',
+	'schacpersonaluniquecode',
+)
+
+
+def _cached_from_attributes(attr: dict) -> CachedUser:
+	if 'signedsir' in attr:
+		signed_sir = attr['signedsir'][0].decode().lower() == 'true'
+	else:
+		signed_sir = False
+	if 'schacpersonaluniquecode' in attr:
+		matricola = attr['schacpersonaluniquecode'][0].decode()
+	else:
+		matricola = None
+	return CachedUser(
+		attr['uid'][0].decode(),
+		attr['cn'][0].decode(),
+		attr['givenname'][0].decode(),
+		signed_sir,
+		(nickname.decode() for nickname in attr.get('weeelabnickname', ())),
+		matricola
+	)
+
+
+def _user_from_cached(cached: CachedUser) -> User:
+	return User(cached.username, cached.full_name, cached.first_name, cached.signed_sir)
+
+
 def get_user(username: str) -> User:
-	found = False
-	ambiguous = False
+	"""
+	Find a user by uid, nickname or matricola, from the cache if fresh enough, otherwise from LDAP.
+	If LDAP can't be reached, stale cached info is better than nothing.
+
+	:param username: Whatever the user typed
+	:return: The user
+	"""
 	matricolized = matricolize(username)
-	username = escape_filter_chars(username)
+	cache = get_cache()
+	with span("usercache.lookup"):
+		cached = cache.lookup(username if matricolized is None else matricolized)
+	if cached is not None and cached[1]:
+		return _user_from_cached(cached[0])
+	try:
+		user = _search_user(username, matricolized)
+	except LdapError:
+		if cached is None:
+			raise
+		print(f"Using cached info for {cached[0].username}, it may be outdated")
+		return _user_from_cached(cached[0])
+	with span("usercache.store"):
+		cache.store(user)
+	return _user_from_cached(user)
+
+
+def get_users(usernames: Iterable[str]) -> Dict[str, User]:
+	"""
+	Find many users at once. Those not fresh in the cache are searched together, with one LDAP query
+	every _BULK_SIZE users instead of one each.
+
+	:param usernames: Whatever has been typed: uid, nickname or matricola
+	:return: What was typed -> user, only for those that have been found
+	"""
+	cache = get_cache()
+	found = {}
+	# what was typed -> matricolized version
+	missing = {}
+	stale = {}
+	with span("usercache.lookup"):
+		for username in usernames:
+			matricolized = matricolize(username)
+			cached = cache.lookup(username if matricolized is None else matricolized)
+			if cached is not None and cached[1]:
+				found[username] = _user_from_cached(cached[0])
+			else:
+				missing[username] = matricolized
+				if cached is not None:
+					stale[username] = cached[0]
+	if len(missing) > 0:
+		try:
+			fetched = _search_users(missing)
+		except LdapError:
+			if len(stale) == 0:
+				raise
+			print(f"Using cached info for {len(stale)} users, it may be outdated")
+			fetched = stale
+		else:
+			with span("usercache.store"):
+				cache.store_many(fetched.values())
+		for username, cached in fetched.items():
+			found[username] = _user_from_cached(cached)
+	return found
+
+
+def refresh_user_cache() -> bool:
+	"""
+	Download every user from LDAP in one go and replace the cache with them
+	"""
+	result = get_connection().search_paged(
+		LDAP_TREE, "(&(objectClass=weeeOpenPerson)(!(nsaccountlock=true)))", _ATTRIBUTES)
+	users = [_cached_from_attributes(entry[1]) for entry in result if 'uid' in entry[1]]
+	get_cache().replace_all(users)
+	print(f"User cache refreshed, {len(users)} users stored")
+	return True
+
+
+def _search_user(username: str, matricolized: Optional[str]) -> CachedUser:
+	from ldap.filter import escape_filter_chars
+	escaped = escape_filter_chars(username)
 	if matricolized is None:
-		filters = (
-			f"(&(objectClass=weeeOpenPerson)(uid={username})(!(nsaccountlock=true)))",
-			f"(&(objectClass=weeeOpenPerson)(weeelabnickname={username})(!(nsaccountlock=true)))"
-		)
+		# uid and nickname in one round trip, uid wins if both match
+		the_filter = f"(&(objectClass=weeeOpenPerson)(|(uid={escaped})(weeelabnickname={escaped}))(!(nsaccountlock=true)))"
 	else:
-		filters = (
-			f"(&(objectClass=weeeOpenPerson)(schacpersonaluniquecode={matricolized})(!(nsaccountlock=true)))",
-		)
-	del matricolized
+		the_filter = f"(&(objectClass=weeeOpenPerson)(schacpersonaluniquecode={escape_filter_chars(matricolized)})(!(nsaccountlock=true)))"
 
-	try:
-		# print(f"Asking {LDAP_SERVER} for info...")
-		conn = ldap.initialize(LDAP_SERVER)
-		conn.protocol_version = ldap.VERSION3
-		if LDAP_SERVER.startswith('ldap://'):
-			conn.start_tls_s()
-		conn.simple_bind_s(LDAP_BIND_DN, LDAP_PASSWORD)
-	except ldap.SERVER_DOWN:
-		print(f"Cannot connect to LDAP server {LDAP_SERVER}")
-		raise LdapError
-	if conn is None:
-		print(f"Error connecting to LDAP server :(")
-		raise LdapError
-
-	for the_filter in filters:
-		result = conn.search_s(LDAP_TREE, ldap.SCOPE_SUBTREE, the_filter, (
-			'uid',
-			'cn',
-			'givenname',
-			'signedsir'
-		))
-		if len(result) > 1:
-			ambiguous = True
-		if len(result) == 1:
-			attr = result[0][1]
-			if 'signedsir' in attr:
-				signed_sir = attr['signedsir'][0].decode().lower() == 'true'
-			else:
-				signed_sir = False
-			return User(attr['uid'][0].decode(), attr['cn'][0].decode(), attr['givenname'][0].decode(), signed_sir)
-	conn.unbind_s()
+	result = get_connection().search(LDAP_TREE, the_filter, _ATTRIBUTES)
+	if len(result) > 1:
+		by_uid = [entry for entry in result if entry[1]['uid'][0].decode().lower() == username.lower()]
+		if len(by_uid) == 1:
+			result = by_uid
 
-	if ambiguous:
+	if len(result) == 1:
+		return _cached_from_attributes(result[0][1])
+	if len(result) > 1:
 		print(f"Multiple accounts found for that username/matricola/nickname, try with another one.")
 		raise UserNotFoundError
-	if not found:
-		print(f"Username not recognized. Maybe you misspelled it or you're an intruder.")
-		raise UserNotFoundError
+	print(f"Username not recognized. Maybe you misspelled it or you're an intruder.")
+	raise UserNotFoundError
 
+
+# Users per query in _search_users, so filters don't get absurdly long
+_BULK_SIZE = 200
+
+
+def _search_users(wanted: Dict[str, Optional[str]]) -> Dict[str, CachedUser]:
+	from ldap.filter import escape_filter_chars
+	items = list(wanted.items())
+	found = {}
+	for start in range(0, len(items), _BULK_SIZE):
+		chunk = items[start:start + _BULK_SIZE]
+		clauses = []
+		for username, matricolized in chunk:
+			if matricolized is None:
+				escaped = escape_filter_chars(username)
+				clauses.append(f"(uid={escaped})(weeelabnickname={escaped})")
+			else:
+				clauses.append(f"(schacpersonaluniquecode={escape_filter_chars(matricolized)})")
+		the_filter = f"(&(objectClass=weeeOpenPerson)(|{''.join(clauses)})(!(nsaccountlock=true)))"
+		result = get_connection().search(LDAP_TREE, the_filter, _ATTRIBUTES)
+
+		by_uid = {}
+		by_nickname = {}
+		by_matricola = {}
+		for entry in result:
+			if 'uid' not in entry[1]:
+				continue
+			user = _cached_from_attributes(entry[1])
+			by_uid[user.username.lower()] = user
+			for nickname in user.nicknames:
+				by_nickname.setdefault(nickname.lower(), []).append(user)
+			if user.matricola:
+				by_matricola[user.matricola.lower()] = user
+		for username, matricolized in chunk:
+			if matricolized is not None:
+				user = by_matricola.get(matricolized.lower())
+			else:
+				# uid wins, then nickname if it's not ambiguous, same as _search_user
+				user = by_uid.get(username.lower())
+				if user is None and len(by_nickname.get(username.lower(), ())) == 1:
+					user = by_nickname[username.lower()][0]
+			if user is not None:
+				found[username] = user
+	return found
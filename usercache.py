@@ -0,0 +1,144 @@
+"""
+On-disk cache of LDAP users.
+
+Records are stored by uid and can be looked up by uid, nickname or matricola. A record younger than
+the TTL is served without asking LDAP at all; an older one is only used when LDAP can't be reached.
+When there are too many records, the ones fetched longest ago are evicted.
+
+The file is read again whenever another process has replaced it (e.g. a --refresh-user-cache while the daemon
+is running), so what's stored on top of it doesn't undo that.
+"""
+
+import json
+import os
+from time import time
+from typing import Dict, Iterable, Optional, Tuple
+
+from atomic import replace_json
+
+
+class CachedUser:
+	"""
+	What's needed to build a User, plus the aliases it can be found with
+	"""
+	__slots__ = ('username', 'full_name', 'first_name', 'signed_sir', 'nicknames', 'matricola', 'fetched')
+
+	def __init__(self, username: str, full_name: str, first_name: str, signed_sir: bool, nicknames: Iterable[str] = (),
+				 matricola: Optional[str] = None, fetched: Optional[float] = None):
+		self.username = username
+		self.full_name = full_name
+		self.first_name = first_name
+		self.signed_sir = signed_sir
+		self.nicknames = list(nicknames)
+		self.matricola = matricola
+		self.fetched = time() if fetched is None else fetched
+
+	def aliases(self):
+		for nickname in self.nicknames:
+			yield nickname.lower()
+		if self.matricola:
+			yield self.matricola.lower()
+
+	def to_dict(self) -> dict:
+		return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+class UserCache:
+	def __init__(self, filename: str, ttl: float, max_entries: int):
+		self.filename = filename
+		self.ttl = ttl
+		self.max_entries = max_entries
+		self._users: Optional[Dict[str, CachedUser]] = None
+		self._aliases: Dict[str, str] = {}
+		# mtime and inode of the file when it was read or written, None if there was no file
+		self._stamp: Optional[Tuple[int, int]] = None
+
+	def _file_stamp(self) -> Optional[Tuple[int, int]]:
+		try:
+			stat = os.stat(self.filename)
+		except OSError:
+			return None
+		return stat.st_mtime_ns, stat.st_ino
+
+	def _load(self):
+		stamp = self._file_stamp()
+		if self._users is not None and stamp == self._stamp:
+			return
+		self._stamp = stamp
+		self._users = {}
+		try:
+			with open(self.filename, "r") as cache_file:
+				for record in json.load(cache_file)['users']:
+					self._add(CachedUser(**record))
+		except (OSError, ValueError, KeyError, TypeError):
+			# Missing or broken cache, start from scratch
+			self._users = {}
+		self._reindex()
+
+	def _add(self, user: CachedUser):
+		self._users[user.username] = user
+
+	def _reindex(self):
+		aliases = {}
+		for user in self._users.values():
+			for key in user.aliases():
+				aliases[key] = user.username
+		# uid wins over someone else's nickname, same as in LDAP lookups
+		for user in self._users.values():
+			aliases[user.username.lower()] = user.username
+		self._aliases = aliases
+
+	def lookup(self, key: str) -> Optional[Tuple[CachedUser, bool]]:
+		"""
+		Find a user by uid, nickname or matricola
+
+		:param key: Any of them, matricola already in "s123456" form
+		:return: The user and whether the record is still fresh, None if not cached
+		"""
+		self._load()
+		username = self._aliases.get(key.lower())
+		if username is None:
+			return None
+		user = self._users[username]
+		return user, time() - user.fetched < self.ttl
+
+	def store(self, user: CachedUser):
+		self.store_many((user,))
+
+	def store_many(self, users: Iterable[CachedUser]):
+		"""
+		Add or update many users, writing the file once
+		"""
+		self._load()
+		for user in users:
+			self._add(user)
+		self._evict()
+		self._reindex()
+		self.save()
+
+	def replace_all(self, users: Iterable[CachedUser]):
+		"""
+		Throw away everything and store these users instead
+		"""
+		self._users = {}
+		for user in users:
+			self._add(user)
+		self._evict()
+		self._reindex()
+		self.save()
+
+	def _evict(self):
+		if len(self._users) <= self.max_entries:
+			return
+		by_age = sorted(self._users.values(), key=lambda cached: cached.fetched)
+		for user in by_age[:len(self._users) - self.max_entries]:
+			del self._users[user.username]
+
+	def __len__(self):
+		self._load()
+		return len(self._users)
+
+	def save(self):
+		# Any login or logout that misses the cache gets here, without the log lock: each one writes its own file
+		stat = replace_json(self.filename, {'users': [user.to_dict() for user in self._users.values()]})
+		self._stamp = stat.st_mtime_ns, stat.st_ino
@@ -1,6 +1,24 @@
-from typing import Optional
-from getpass import getuser
-import user
+import os
+import sys
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Pattern, Tuple
+from datetime import datetime
+from itertools import islice
+
+from constans import *
+from user import User, LdapError, UserNotFoundError, get_user, get_users, matricolize, refresh_user_cache
+from presence import PresenceIndex, index_filename
+from totals import TotalsCache
+from locking import LockTimeoutError, log_lock
+from journal import commit, recover, replace_file, journal_filename
+from logparse import LogRecord, parse_line, parse_duration, iter_records, iter_lines, iter_lines_backwards, format_duration
+from messages import messages_filename, read_messages
+from history import history_stats, write_month, rebuild_summaries
+from timing import span
+from batch import read_events, plan
+from background import Background
+from cardreader import get_decoder
+from output import iso, write_lines, write_rows
+
 
 # utils
 def secure_exit(return_value=0):
@@ -42,61 +60,57 @@ def check_hour(input_hour: str) -> bool:
     return True
 
 
-def matricolize(username: str):
-    """
-    Take a username and turn it in a matricole number
+def presence() -> PresenceIndex:
+	"""
+	Get the presence index for the current log file, up to date with it.
 
-    :param username: of the user
-    :return matricole: number
-    """
-    if username.isdigit():
-        return f"s{username}"
+	:return: The index
+	"""
+	global _presence
+	if _presence is None or _presence.log_filename != LOG_FILENAME:
+		_presence = PresenceIndex(LOG_FILENAME)
+	_presence.load()
+	return _presence
 
-    if username[1:].isdigit() and username[0] in ('s', 'S', 'd', 'D'):
-        return username
-    return None
 
-def is_logged_in(username: str) -> bool:
+_presence = None
+
+
+def totals() -> TotalsCache:
 	"""
-	Check if user is already logged in.
+	Get the cached per-user totals for rotated log files, up to date with them.
 
-	:param username: normalized username
-	:return:
+	:return: The totals
 	"""
-	logged = False
-	with open(LOG_FILENAME, "r") as log_file:
-		for line in log_file:
-			if inlab_line(line) and user_in_line(line, username):
-				logged = True
-				break
-	return logged
+	global _totals
+	if _totals is None or _totals.log_filename != LOG_FILENAME:
+		_totals = TotalsCache(LOG_FILENAME)
+	_totals.load()
+	return _totals
 
 
-def people_in_lab() -> int:
-	count = 0
-	with open(LOG_FILENAME, "r") as log_file:
-		for line in log_file:
-			if inlab_line(line):
-				count += 1
-	return count
+_totals = None
 
 
-def is_empty(input_file) -> bool:
+def is_logged_in(username: str) -> bool:
 	"""
-	Check if inputFile is empty.
+	Check if user is already logged in.
 
-	:param input_file:
+	:param username: normalized username
 	:return:
 	"""
-	if str(input_file.read())[:1] == "":
-		input_file.close()
-		return True
-	else:
-		input_file.seek(0)
-		return False
+	return presence().is_in(username)
+
+
+def people_in_lab() -> int:
+	return presence().count()
 
 
 def ensure_log_file():
+	if os.path.exists(journal_filename(LOG_FILENAME)):
+		with log_lock(LOG_FILENAME, LOCK_TIMEOUT):
+			if recover(LOG_FILENAME):
+				print(f"Recovered changes interrupted by a crash")
 	if not os.path.exists(LOG_FILENAME):
 		if os.path.isdir(os.path.dirname(LOG_FILENAME)):
 			print(f"Creating empty log.txt")
@@ -116,32 +130,55 @@ def store_log_to(filename, destination):
 	if DEBUG_MODE:
 		print(f"DEBUG_MODE, skipped copying {os.path.basename(filename)} to {destination}")
 	else:
+		from shutil import copy2
 		copy2(filename, destination)
 
 
 def create_backup_if_necessary():
-	# Open master log file
-	with open(LOG_FILENAME, "r") as log_file:
-		if not is_empty(log_file):  # If current log file is not empty
-			last_month_year = str(log_file.read())[4:11]
-
-			curr_month = int(datetime.now().strftime("%m"))
-			curr_year = int(datetime.now().strftime("%Y"))
-			last_date = datetime.strptime(last_month_year, "%m/%Y")
-			last_month = int(last_date.strftime("%m"))
-			last_year = int(last_date.strftime("%Y"))
-
-			# If the inexorable passage of time has been perceived by this program, too...
-			if (curr_month > last_month) or (curr_year > last_year):
-				# log.txt -> log201901.txt, foo.txt -> foo201901.txt, etc...
-				stored_log_filename = LOG_FILENAME.rsplit('.', 1)[0] + last_date.strftime("%Y%m") + ".txt"
-				print(f"Backing up log file to {os.path.basename(stored_log_filename)}")
-				os.rename(LOG_FILENAME, stored_log_filename)
-				# store_log_to(stored_log_filename, BACKUP_PATH)
-				# print(f"Done!")
-
-				open(LOG_FILENAME, "a").close()
-				print(f"New log file was created.")
+	# Cheap check first, without the lock: most of the time there's nothing to do
+	if _month_to_rotate() is None:
+		return
+	with log_lock(LOG_FILENAME, LOCK_TIMEOUT):
+		# Someone else may have done it in the meantime
+		last_date = _month_to_rotate()
+		if last_date is None:
+			return
+		# log.txt -> log201901.txt, foo.txt -> foo201901.txt, etc...
+		stored_log_filename = LOG_FILENAME.rsplit('.', 1)[0] + last_date.strftime("%Y%m") + ".txt"
+		print(f"Backing up log file to {os.path.basename(stored_log_filename)}")
+		with span("rotate"):
+			commit(LOG_FILENAME, [{'op': 'rotate', 'stored': stored_log_filename}])
+			write_month(stored_log_filename)
+		# The checkpoint was about the old file
+		global _presence
+		_presence = None
+		if os.path.exists(index_filename(LOG_FILENAME)):
+			os.remove(index_filename(LOG_FILENAME))
+		# store_log_to(stored_log_filename, BACKUP_PATH)
+		# print(f"Done!")
+
+		print(f"New log file was created.")
+
+
+def _month_to_rotate() -> Optional[datetime]:
+	"""
+	Check if the log file belongs to a past month, reading only the date of the first line
+
+	:return: Month of the log file if it has to be rotated, None otherwise
+	"""
+	# [02/05/2017 10:00] ...
+	with open(LOG_FILENAME, "rb") as log_file:
+		first_date = log_file.read(11)
+	if len(first_date) < 11:
+		# Empty file
+		return None
+	last_date = datetime.strptime(first_date[4:11].decode('utf-8'), "%m/%Y")
+	now = datetime.now()
+	# If the inexorable passage of time has been perceived by this program, too...
+	if (now.year, now.month) > (last_date.year, last_date.month):
+		return last_date
+	return None
+
 
 def login(username: str, use_ldap: bool):
 	"""
@@ -151,8 +188,6 @@ def login(username: str, use_ldap: bool):
 	:param username: User-supplied username
 	"""
 
-	lab_was_empty = people_in_lab() == 0
-
 	if use_ldap:
 		user = get_user(username)
 		username = user.username
@@ -164,65 +199,98 @@ def login(username: str, use_ldap: bool):
 		print(COLOR_NATIVE)
 		pretty_name = username
 
-	if is_logged_in(username):
-		print(f"{pretty_name}, you're already logged in.")
-	else:
+	with log_lock(LOG_FILENAME, LOCK_TIMEOUT):
+		if is_logged_in(username):
+			print(f"{pretty_name}, you're already logged in.")
+			return
+		index = presence()
+		# The index was just loaded by is_logged_in, counting doesn't read anything
+		lab_was_empty = index.count() == 0
 		curr_time = datetime.now().strftime("%d/%m/%Y %H:%M")
 		login_string = f"[{curr_time}] [----------------] [INLAB] <{username}>\n"
-		with open(LOG_FILENAME, "a") as log_file:
-			log_file.write(login_string)
+		offset = os.path.getsize(LOG_FILENAME)
+		commit(LOG_FILENAME, [{'op': 'append', 'offset': offset, 'line': login_string}])
+		index.add(username, offset)
+		index.save()
 
-		# store_log_to(LOG_FILENAME, BACKUP_PATH)
+	# store_log_to(LOG_FILENAME, BACKUP_PATH)
 
-		if lab_was_empty:
-			global FIRST_IN_HAPPENED
-			FIRST_IN_HAPPENED = True
-		print(f"Login successful! Hello {pretty_name}!")
+	if lab_was_empty:
+		global FIRST_IN_HAPPENED
+		FIRST_IN_HAPPENED = True
+	print(f"Login successful! Hello {pretty_name}!")
 
 
-def logout(username: str, use_ldap: bool, message: Optional[str] = None):
+def _alias_in_lab(username: str, user: User) -> bool:
+	"""
+	Check that someone who isn't in lab with the name they typed is there with their real username
+
+	:param username: User-supplied username
+	:param user: What LDAP found for it
+	:return: True if in lab, False (and tell them) otherwise
+	"""
+	if username == user.username or not is_logged_in(user.username):
+		print(f"You aren't in lab! Did you forget to log in?")
+		return False
+	return True
+
+
+def logout(username: str, use_ldap: bool, message: Optional[str] = None,
+		   ask: Optional[Callable[[], str]] = None):
 	"""
 	Log out.
 
 	:param message: Logout message, None to ask
 	:param use_ldap: Connect to remote LDAP server or blindly trust the input
 	:param username: User-supplied username
+	:param ask: What asks for the message, ask_work_done if None
 	"""
 
-	last_person = people_in_lab() == 1
-
 	if not use_ldap:
 		print(COLOR_RED)
 		print("WARNING: bypassing LDAP lookup, make sure that this is the correct username and not an alias")
 		print(COLOR_NATIVE)
 
+	lookup = None
 	if is_logged_in(username):
 		# Using username, and found
 		pretty_name = username
+	elif use_ldap:
+		# Not found, is it an alias? Ask LDAP for the real username while the message is being typed
+		lookup = Background(get_user, username)
 	else:
-		# Not found, is it an alias?
-		if use_ldap:
-			# Grab the real username
-			user = get_user(username)
-			new_username = user.username
-			pretty_name = user.full_name
-			check_sir(user)
-			if username == new_username or not is_logged_in(new_username):
-				print(f"You aren't in lab! Did you forget to log in?")
-				return False
-			username = new_username
-		else:
-			# Cannot get it from LDAP
-			print(f"You aren't in lab! Did you use an alias or ID number? These do not work right now")
+		# Cannot get it from LDAP
+		print(f"You aren't in lab! Did you use an alias or ID number? These do not work right now")
+		return False
+
+	user = None
+	# From the user cache it takes a few milliseconds: if something's wrong, say it before making them type the message
+	if lookup is not None and lookup.done(0.05):
+		user = lookup.join()
+		if not _alias_in_lab(username, user):
 			return False
 
 	curr_time = datetime.now().strftime("%d/%m/%Y %H:%M")
 	if message is None:
-		workdone = ask_work_done()
+		workdone = (ask or ask_work_done)()
 	else:
 		workdone = message
 
-	if write_logout(username, curr_time, workdone):
+	if lookup is not None:
+		if user is None:
+			user = lookup.join()
+		pretty_name = user.full_name
+		check_sir(user)
+		# Again, in case they logged out from somewhere else while typing
+		if not _alias_in_lab(username, user):
+			return False
+		username = user.username
+
+	with log_lock(LOG_FILENAME, LOCK_TIMEOUT):
+		logged_out = write_logout(username, curr_time, workdone)
+		# Same index that write_logout has just updated, no need to load it again
+		last_person = _presence.count() == 0
+	if logged_out:
 		if last_person:
 			global LAST_OUT_HAPPENED
 			LAST_OUT_HAPPENED = True
@@ -233,17 +301,99 @@ def logout(username: str, use_ldap: bool, message: Optional[str] = None):
 		return False
 
 
+def check_logout(username: str, use_ldap: bool) -> bool:
+	"""
+	Tell whether logout would work, without doing it: interactive logouts through the daemon ask this before
+	the message, so nobody types it for nothing
+
+	:param use_ldap: Connect to remote LDAP server or blindly trust the input
+	:param username: User-supplied username
+	:return: True if the user is in lab
+	"""
+	if is_logged_in(username):
+		return True
+	if not use_ldap:
+		print(f"You aren't in lab! Did you use an alias or ID number? These do not work right now")
+		return False
+	return _alias_in_lab(username, get_user(username))
+
+
+def replay_batch(filename: str, use_ldap: bool, dry_run: bool) -> bool:
+	"""
+	Apply many logins and logouts from a file, in a single pass: all of them, or none if anything's wrong.
+	First in/last out scripts are not run, these things happened in the past.
+
+	:param filename: CSV or JSONL file, see batch.py
+	:param use_ldap: Resolve usernames on LDAP or take them as they are
+	:param dry_run: Only show what would be done
+	:return: True if everything was fine
+	"""
+	try:
+		events, errors = read_events(filename)
+	except OSError as e:
+		print(f"Cannot read {filename}: {e.strerror}")
+		return False
+
+	if use_ldap:
+		if len(events) > 0:
+			users = get_users({event.username for event in events})
+			resolved = []
+			for event in events:
+				user = users.get(event.username)
+				if user is None:
+					errors.append(f"Line {event.line}: {event.username} not found")
+				else:
+					event.username = user.username
+					resolved.append(event)
+			events = resolved
+	else:
+		print(COLOR_RED)
+		print("WARNING: bypassing LDAP lookup, make sure that these are the correct usernames and not aliases")
+		print(COLOR_NATIVE)
+
+	with log_lock(LOG_FILENAME, LOCK_TIMEOUT):
+		changes, plan_errors = plan(events, LOG_FILENAME, presence())
+		errors.extend(plan_errors)
+		if len(errors) > 0:
+			for error in errors:
+				print(error)
+			print(f"{len(errors)} errors found, nothing has been written")
+			return False
+		for event in sorted(events, key=lambda e: e.time):
+			print(event)
+		if dry_run:
+			print(f"Dry run: {len(events)} events can be applied, nothing has been written")
+			return True
+		commit(LOG_FILENAME, changes)
+		# Picks up the new lines
+		presence()
+	print(f"{len(events)} events written")
+	return True
+
+
 def check_sir(user):
 	global SIR_HAPPENED
 	SIR_HAPPENED = not user.signed_sir
 
 
+def enable_line_editing():
+	"""
+	Allow using backspace and arrow keys in input(). Only needed when asking something to someone:
+	importing readline sets up the terminal, which takes a while.
+	"""
+	# noinspection PyUnresolvedReferences
+	import readline
+
+
 def ask_work_done():
+	enable_line_editing()
 	try:
 		ok = False
 		workdone = ""
 		while not ok:
-			workdone = input(f"What have you done?\n:: ").strip()
+			# Not slow, just waiting for a human: good to know how much of the total it is
+			with span("input"):
+				workdone = input(f"What have you done?\n:: ").strip()
 			if len(workdone) > MAX_WORK_DONE:
 				print(f"I didn't ask you the story of your life! Type a shorter sentence!")
 			elif len(workdone) <= 0:
@@ -268,60 +418,61 @@ def work_time(timein, timeout) -> str:
 	return str(hours).zfill(2) + ":" + str(minutes).zfill(2)
 
 
-def inlab_line(line: str) -> bool:
-	# [02/05/2017 10:00] [----------------] [INLAB] :: <
-	return line[39:44] == "INLAB"
-
-
-def user_in_line(line: str, username: str) -> bool:
-	username_in_line = line.split('<', 1)[1].split('>', 1)[0]
-	return username == username_in_line
-
-
 def write_logout(username, curr_time, workdone) -> bool:
 	"""
-	I don't even want to know. This thing works, it's ok, don't touch it
-	"""
-	found = False
-
-	log_list = []
-	with open(LOG_FILENAME, "r") as log_file:
-		for line in log_file:
-			if inlab_line(line) and user_in_line(line, username):
-				found = True
-				login_time = line[12:17]
-				logout_time = curr_time[11:17]
-				line = line.replace("----------------", curr_time)
-				line = line.replace("INLAB", work_time(login_time, logout_time))
-				line = line.replace("\n", "")
+	Close the [INLAB] line of a user, found through the presence index.
 
-				line = line + " :: " + workdone + "\n"
-			log_list.append(line)  # Store everything in the list
+	Logout time and duration are patched in place over the "[----------------] [INLAB]" part,
+	nothing before that line is ever rewritten. The message is appended to the line if it's the
+	last one in the log, otherwise it goes to the companion messages file.
+	"""
+	with log_lock(LOG_FILENAME, LOCK_TIMEOUT):
+		return _write_logout(username, curr_time, workdone)
 
-	if found:
-		# add .lock file during writing process if there isn't one, wait until it's removed, then re-add it
-		while True:
-			try:
-				with open(LOG_FILENAME+'.lock', 'x'):
-					break
-			except FileExistsError:
-				sleep(.5)
 
-		# Writing everything to log file
-		with open(LOG_FILENAME, "w") as log_file:
-			for line in log_list:
-				log_file.write(line)
+def _write_logout(username, curr_time, workdone) -> bool:
+	index = presence()
+	offset = index.offset(username)
+	if offset is None:
+		return False
 
-		# remove .lock file
-		os.remove(LOG_FILENAME+'.lock')
+	with open(LOG_FILENAME, "rb") as log_file:
+		log_file.seek(offset)
+		line = log_file.readline()
+		end = log_file.tell()
+		last_line = end == log_file.seek(0, os.SEEK_END)
+
+	login_time = parse_line(line, offset).login.strftime("%H:%M")
+	logout_time = curr_time[11:17]
+	duration = work_time(login_time, logout_time)
+
+	if len(duration) == 5:
+		commit(LOG_FILENAME, [{
+			'op': 'close',
+			'offset': offset,
+			'logout': curr_time,
+			'duration': duration,
+			'message': workdone,
+			'end': end if last_line else None,
+		}])
+	else:
+		# Negative or huge durations don't fit, a new file with the rewritten line replaces the old one.
+		# Every line after it moves, companion messages included: start the index again from the new file.
+		_rewrite_closing({offset: (username, duration)}, curr_time, workdone)
+		index.reset()
+		index.load()
+		return True
+	index.remove(username, parse_duration(duration.encode('utf-8')))
+	index.save()
 
-		# store_log_to(LOG_FILENAME, BACKUP_PATH)
+	# store_log_to(LOG_FILENAME, BACKUP_PATH)
 
-	return found
+	return True
 
 
 # logout by passing manually date and time
 def manual_logout():
+	enable_line_editing()
 	sys.stdout.write(COLOR_RED)
 	username = input("ADMIN--> insert username: ")
 
@@ -349,39 +500,227 @@ def manual_logout():
 		print("ADMIN--> Update failed (not logged in?)")
 
 
-def logfile():
-	print(f"Reading log file...\n")
-	with open(LOG_FILENAME, "r") as log_file:
-		for line in log_file:
-			print(line, end='')
+def close_sessions(usernames: Optional[List[str]], curr_time: str, message: str) -> bool:
+	"""
+	Log out many users at once, at the same time and with the same message: for whoever forgot to do it,
+	from a nightly cron job. Everything is written in a single pass, under the lock.
+
+	:param usernames: Who, None for everyone in lab
+	:param curr_time: Logout time, dd/mm/YYYY HH:MM
+	:param message: Logout message
+	:return: True if every session could be closed
+	"""
+	logout_time = datetime.strptime(curr_time, "%d/%m/%Y %H:%M")
+	result = True
+	with log_lock(LOG_FILENAME, LOCK_TIMEOUT):
+		index = presence()
+		if usernames is None:
+			usernames = index.usernames()
+		# offset -> username, duration
+		closing: Dict[int, Tuple[str, str]] = {}
+		size = os.path.getsize(LOG_FILENAME)
+		last_start = None
+		with open(LOG_FILENAME, "rb") as log_file:
+			for username in usernames:
+				offset = index.offset(username)
+				if offset is None:
+					print(f"{username} isn't in lab")
+					result = False
+					continue
+				log_file.seek(offset)
+				line = log_file.readline()
+				minutes = int((logout_time - parse_line(line, offset).login).total_seconds()) // 60
+				if minutes < 0:
+					print(f"{username} logged in after {curr_time}, skipped")
+					result = False
+					continue
+				closing[offset] = (username, format_duration(minutes))
+				if offset + len(line) == size:
+					last_start = offset
+
+		if len(closing) == 0:
+			print(f"Nobody to log out")
+			return result
+		# Everyone being closed is in the index, so it says whether anyone stays without loading it again
+		last_person = index.count() == len(closing)
+		if all(len(duration) == 5 for username, duration in closing.values()):
+			commit(LOG_FILENAME, [{
+				'op': 'close',
+				'offset': offset,
+				'logout': curr_time,
+				'duration': duration,
+				'message': message,
+				'end': size if offset == last_start else None,
+			} for offset, (username, duration) in sorted(closing.items())])
+		else:
+			# Someone has been in for more than 99 hours, that doesn't fit in place
+			_rewrite_closing(closing, curr_time, message)
+			index.reset()
+
+	for offset, (username, duration) in sorted(closing.items()):
+		print(f"Logged out {username} at {curr_time} after {duration}")
+	if last_person:
+		global LAST_OUT_HAPPENED
+		LAST_OUT_HAPPENED = True
+	return result
+
 
+def _rewrite_closing(closing: Dict[int, Tuple[str, str]], curr_time: str, message: str):
+	"""
+	Write the log again in a single pass, closing some lines. Every line after them moves, so the offsets
+	in the companion messages file become meaningless: messages are moved back into their lines.
+	"""
+	messages = read_messages(LOG_FILENAME)
+
+	def lines():
+		offset = 0
+		with open(LOG_FILENAME, "rb") as log_file:
+			for line in log_file:
+				length = len(line)
+				if offset in closing:
+					username, duration = closing[offset]
+					line = f"{line[:18].decode('utf-8')} [{curr_time}] [{duration}] <{username}> :: {message}\n".encode('utf-8')
+				elif offset in messages and b" :: " not in line:
+					line = line.rstrip(b"\n") + f" :: {messages[offset]}\n".encode('utf-8')
+				offset += length
+				yield line
+
+	replace_file(LOG_FILENAME, lines())
+	if os.path.exists(messages_filename(LOG_FILENAME)):
+		os.remove(messages_filename(LOG_FILENAME))
+
+
+def logfile(fmt: str = 'text', tail: Optional[int] = None, username: Optional[str] = None,
+			since: Optional[datetime] = None, until: Optional[datetime] = None, pattern: Optional[Pattern] = None):
+	"""
+	Print sessions in the log of this month, all of them or only some. As text, lines are shown as they are
+	in the file (with their message), even those that aren't sessions, unless filtering by user or time.
+
+	:param fmt: text, or a format from output.FORMATS
+	:param tail: Only the last N that match, None for all
+	:param username: Only sessions of this user
+	:param since: Only sessions started from here
+	:param until: Only sessions started up to here
+	:param pattern: Only sessions where the line matches this
+	"""
+	sessions_only = fmt != 'text'
+	with span("log.read"):
+		if tail is None:
+			lines = _filter_lines(iter_lines(LOG_FILENAME), sessions_only, username, since, until, pattern)
+		else:
+			# From the end, stopping as soon as there are enough: the rest of the file isn't even read
+			newest = _filter_lines(iter_lines_backwards(LOG_FILENAME), sessions_only, username, since, until, pattern)
+			lines = reversed(list(islice(newest, tail)))
+		if fmt == 'text':
+			print(f"Reading log file...\n")
+			write_lines(line for line, record in lines)
+		else:
+			write_rows(({
+				'login': iso(record.login),
+				'logout': iso(record.logout),
+				'duration': record.duration,
+				'username': record.username,
+				'message': record.message,
+			} for line, record in lines), fmt, ['login', 'logout', 'duration', 'username', 'message'])
+
+
+def _filter_lines(lines: Iterable[Tuple[str, Optional[LogRecord]]], sessions_only: bool, username: Optional[str],
+				  since: Optional[datetime], until: Optional[datetime],
+				  pattern: Optional[Pattern]) -> Iterator[Tuple[str, Optional[LogRecord]]]:
+	for line, record in lines:
+		if record is None:
+			# Nothing to know about who or when
+			if sessions_only or username is not None or since is not None or until is not None:
+				continue
+		else:
+			if username is not None and record.username != username:
+				continue
+			if since is not None and record.login < since:
+				continue
+			if until is not None and record.login > until:
+				continue
+		if pattern is not None and pattern.search(line) is None:
+			continue
+		yield line, record
+
+
+def inlab(fmt: str = 'text'):
+	"""
+	Print who's in lab
 
-def inlab():
-	count = 0
-	print(f"Reading log file...\n")
-	with open(LOG_FILENAME, "r") as log_file:
-		for line in log_file:
-			if inlab_line(line):
-				count += 1
-				username = line[47:line.rfind(">")]
-				print("> " + username)
+	:param fmt: text, or a format from output.FORMATS
+	"""
+	index = presence()
+	if fmt == 'text':
+		print(inlab_text(index.usernames()), end='')
+		return
 
+	def rows():
+		with open(LOG_FILENAME, "rb") as log_file:
+			for username in index.usernames():
+				offset = index.offset(username)
+				log_file.seek(offset)
+				yield {'username': username, 'login': iso(parse_line(log_file.readline(), offset).login)}
+
+	write_rows(rows(), fmt, ['username', 'login'])
+
+
+def inlab_text(usernames: List[str]) -> str:
+	"""
+	:param usernames: Users in lab
+	:return: What -p prints, one line each and then how many they are
+	"""
+	lines = ["> " + username + "\n" for username in usernames]
+	count = len(usernames)
 	if count == 0:
-		print(f"Nobody is in lab right now.")
+		lines.append(f"Nobody is in lab right now.\n")
 	elif count == 1:
-		print(f"There is one student in lab right now.")
+		lines.append(f"There is one student in lab right now.\n")
 	else:
-		print(f"There are {count} students in lab right now.")
+		lines.append(f"There are {count} students in lab right now.\n")
+	return "".join(lines)
+
+
+def watch_inlab():
+	"""
+	Show who's in lab and keep it updated until ctrl+C. The screen is redrawn only when someone comes or goes,
+	in between this just sleeps waiting for the log to change.
+	"""
+	from watch import LogWatcher
+	clear = "\033[H\033[2J" if sys.stdout.isatty() else ""
+	shown = None
+	# Its own copy, kept in memory only: the watcher wakes up as soon as a writer commits, and saving would mean
+	# taking the lock right when the next login may want it. The writer saves the index anyway.
+	index = PresenceIndex(LOG_FILENAME)
+	try:
+		with LogWatcher(LOG_FILENAME) as watcher:
+			while True:
+				try:
+					# Only what has been added or rewritten since last time is parsed, straight from the log
+					index.load(persist=False)
+					usernames = index.usernames()
+				except FileNotFoundError:
+					# Rotated, the new one isn't there yet
+					usernames = []
+				if usernames != shown:
+					shown = usernames
+					sys.stdout.write(clear + inlab_text(usernames) + datetime.now().strftime("Updated %d/%m/%Y %H:%M\n"))
+					sys.stdout.flush()
+				watcher.wait()
+	except KeyboardInterrupt:
+		pass
 
 
-# Returns total work time in minutes
+# Returns total work time in minutes, over all log files
 def tot_work_time(username):
-	time_spent = 0
-	with open(LOG_FILENAME, "r") as log_file:
-		for line in log_file:
-			if user_in_line(username, line) and not inlab_line(line):
-				time_spent += ((int(line[39:41]) * 60) + int(line[42:44]))
-	return time_spent
+	return all_totals().get(username, 0)
+
+
+def all_totals() -> Dict[str, int]:
+	"""
+	Minutes in lab for everyone, over all the log files
+	"""
+	return totals().totals(presence().minutes())
 
 
 # Convert minutes in a formatted string
@@ -389,28 +728,139 @@ def time_conv(minutes):
 	return str(int(minutes / 60)) + " h " + str(int(minutes % 60)) + " m"
 
 
-def interactive_log(in_: bool, use_ldap: bool):
+def stats(since: Optional[datetime] = None, until: Optional[datetime] = None, fmt: str = 'text'):
+	"""
+	Print hours, sessions and last time in lab for everyone, over all the log files
+
+	:param fmt: text, or a format from output.FORMATS
+	"""
+	if fmt == 'text':
+		print(f"Reading log files...\n")
+	with span("history"):
+		all_stats = history_stats(LOG_FILENAME, since, until)
+	if fmt != 'text':
+		write_rows(({
+			'username': username,
+			'minutes': user_stats.minutes,
+			'sessions': user_stats.sessions,
+			'last_seen': iso(user_stats.last_seen),
+		} for username, user_stats in sorted(all_stats.items(), key=lambda item: item[1].minutes, reverse=True)),
+			fmt, ['username', 'minutes', 'sessions', 'last_seen'])
+		return
+	if len(all_stats) == 0:
+		print(f"Nobody has been in lab in that period.")
+		return
+	width = max(len(username) for username in all_stats)
+	for username, user_stats in sorted(all_stats.items(), key=lambda item: item[1].minutes, reverse=True):
+		last_seen = user_stats.last_seen.strftime("%d/%m/%Y")
+		print(f"{username.ljust(width)}  {time_conv(user_stats.minutes).rjust(12)}  {user_stats.sessions:5d} sessions  last seen {last_seen}")
+
+
+def print_totals(fmt: str = 'text'):
+	"""
+	Print total time in lab for everyone, over all the log files
+
+	:param fmt: text, or a format from output.FORMATS
+	"""
+	user_totals = all_totals()
+	if fmt != 'text':
+		write_rows(({'username': username, 'minutes': minutes}
+					for username, minutes in sorted(user_totals.items(), key=lambda item: item[1], reverse=True)),
+				   fmt, ['username', 'minutes'])
+		return
+	if len(user_totals) == 0:
+		print(f"Nobody has ever been in lab.")
+		return
+	width = max(len(username) for username in user_totals)
+	for username, minutes in sorted(user_totals.items(), key=lambda item: item[1], reverse=True):
+		print(f"{username.ljust(width)}  {time_conv(minutes).rjust(12)}")
+
+
+def summaries():
+	print(f"Writing summaries and archives...")
+	count = rebuild_summaries(LOG_FILENAME)
+	print(f"Done, {count} months summarized.")
+
+
+def forwarded(socket_filename: str, request: dict) -> Optional[bool]:
+	"""
+	Have the daemon do something, as if it had been done here: its output is printed, first in/last out/SIR are
+	noted and LDAP problems raise LdapError
+
+	:param socket_filename: Where the daemon is listening
+	:param request: What to ask, see daemon.py
+	:return: The result, None if no daemon answered
+	"""
+	from daemon import forward
+	response = forward(socket_filename, request)
+	if response is None:
+		return None
+	print(response['output'], end='')
+	global FIRST_IN_HAPPENED, LAST_OUT_HAPPENED, SIR_HAPPENED
+	FIRST_IN_HAPPENED = FIRST_IN_HAPPENED or response['first_in']
+	LAST_OUT_HAPPENED = LAST_OUT_HAPPENED or response['last_out']
+	SIR_HAPPENED = SIR_HAPPENED or response['sir']
+	if response.get('ldap_error'):
+		raise LdapError
+	return response['result']
+
+
+def interactive_log(in_: bool, use_ldap: bool, socket_filename: Optional[str] = None):
+	"""
+	Ask who's logging in or out (and the message), until it works or the user gives up
+
+	:param in_: Login or logout
+	:param use_ldap: Connect to remote LDAP server or blindly trust the input
+	:param socket_filename: Daemon to hand logins and logouts to, if it's running. Questions are still asked here.
+	:return: True if done
+	"""
+	enable_line_editing()
 	retry = True
 	retry_username = None
+	# The message is asked once: if the name turns out to be wrong or LDAP fails after it has been typed, only
+	# the name is asked again
+	workdone = []
+
+	def ask_once() -> str:
+		if len(workdone) == 0:
+			workdone.append(ask_work_done())
+		return workdone[0]
+
 	while retry:
 		try:
 			if retry_username:
 				username = retry_username
 				retry_username = None
 			else:
-				username = input("Type your name.surname OR id (matricola) OR nickname OR swipe the card on the reader:\n")
+				with span("input"):
+					username = input("Type your name.surname OR id (matricola) OR nickname OR swipe the card on the reader:\n")
 				matricola_scan = read_from_card_reader(username)
 				if matricola_scan:  # Input with magnetic card
 					username = matricola_scan
 
 			try:
+				res = None
 				if in_:
-					login(username, use_ldap)
-					return True
-				else:
-					res = logout(username, use_ldap)
-					if res:
+					if socket_filename is not None:
+						res = forwarded(socket_filename, {'action': 'login', 'username': username, 'ldap': use_ldap})
+					if res is None:
+						login(username, use_ldap)
 						return True
+				else:
+					if socket_filename is not None:
+						res = forwarded(socket_filename, {'action': 'check_logout', 'username': username, 'ldap': use_ldap})
+						if res:
+							res = forwarded(socket_filename, {
+								'action': 'logout',
+								'username': username,
+								'message': ask_once(),
+								'ldap': use_ldap
+							})
+					if res is None:
+						# No daemon, or it has gone away in the meantime
+						res = logout(username, use_ldap, ask=ask_once)
+				if res:
+					return True
 			except LdapError:
 				retry_ldap_question = True
 				print(f"Hmmm... It seems the network or the LDAP server has some problems.")
@@ -434,46 +884,15 @@ def interactive_log(in_: bool, use_ldap: bool):
 
 
 def read_from_card_reader(text: str) -> Optional[str]:
-	old_format = False
-	direction = None
-	# matricola = None
-	if text[0] == "ò":
-		if text[-1] == "-":
-			direction = " from top to bottom"
-			old_format = True
-		elif text[-1] == "_":
-			direction = " from bottom to top"
-			old_format = True
-	elif text[0] == ";":
-		if text[-1] == "/":
-			direction = " from top to bottom"
-			old_format = True
-		elif text[-1] == "?":
-			direction = " from bottom to top"
-			old_format = True
-
-	if old_format:
-		matricola = text[9:15]
-	else:
-		matricola = read_from_card_reader_o_accentata(text, "ò")
-		if not matricola:
-			matricola = read_from_card_reader_o_accentata(text, ";")
-
-	if matricola is not None:
-		print(f"Detected card scan{direction if direction else ''} with matricola {matricola}")
-		return matricola
-	return None
-
+	"""
+	Check if the input is a card swipe
 
-def read_from_card_reader_o_accentata(text: str, delimiter: str):
-	try:
-		i = 0
-		while 1:
-			i = text.index(delimiter, i)
-			if text[i + 1:i + 5] == "0000" and len(text) > i + 15 + 1:
-				return text[i + 9:i + 15]
-	except ValueError:
+	:param text: What was typed or swiped
+	:return: Matricola if it's a swipe, None otherwise
+	"""
+	decoded = get_decoder().decode(text)
+	if decoded is None:
 		return None
-
-
-
+	matricola, direction = decoded
+	print(f"Detected card scan{' from ' + direction if direction else ''} with matricola {matricola}")
+	return matricola
@@ -0,0 +1,125 @@
+"""
+Wait for the log file to change, without reading it over and over.
+
+On Linux this uses inotify on the directory of the log (rotation and rewrites replace the file, so watching
+the file itself isn't enough), through ctypes. Everywhere else, or if inotify isn't available, it falls back
+to checking size, mtime and inode of the log every few seconds.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+from typing import List, Optional
+
+from presence import log_stamp
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+_EVENT = struct.Struct("iIII")
+
+# Seconds between checks when there's no inotify
+POLL_INTERVAL = 2.0
+
+
+class _Inotify:
+	def __init__(self, directory: str):
+		libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+		mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+		if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+			errno = ctypes.get_errno()
+			os.close(self.fd)
+			raise OSError(errno, f"can't watch {directory}")
+
+	def names(self) -> Optional[List[str]]:
+		"""
+		Block until something happens in the directory
+
+		:return: Names of the files that changed, None if some events were lost
+		"""
+		select.select([self.fd], [], [])
+		names = []
+		while True:
+			try:
+				data = os.read(self.fd, 64 * 1024)
+			except BlockingIOError:
+				return names
+			position = 0
+			while position < len(data):
+				wd, mask, cookie, length = _EVENT.unpack_from(data, position)
+				position += _EVENT.size
+				if mask & IN_Q_OVERFLOW:
+					return None
+				names.append(os.fsdecode(data[position:position + length].rstrip(b"\0")))
+				position += length
+
+	def close(self):
+		os.close(self.fd)
+
+
+class LogWatcher:
+	"""
+	Tells when the log file has changed: wait() blocks until it does.
+	"""
+
+	def __init__(self, log_filename: str):
+		self.log_filename = log_filename
+		self._name = os.path.basename(log_filename)
+		try:
+			self._inotify = _Inotify(os.path.dirname(os.path.abspath(log_filename)))
+		except (OSError, AttributeError, TypeError):
+			# Not Linux, no libc, too many watches...
+			self._inotify = None
+		self._stamp = self._current_stamp()
+
+	@property
+	def uses_inotify(self) -> bool:
+		return self._inotify is not None
+
+	def _current_stamp(self) -> Optional[List[int]]:
+		try:
+			return log_stamp(self.log_filename)
+		except FileNotFoundError:
+			# Between a rotation and the next login
+			return None
+
+	def wait(self):
+		"""
+		Return when the log has been written, replaced or removed
+		"""
+		while True:
+			if self._inotify is None:
+				select.select([], [], [], POLL_INTERVAL)
+			else:
+				names = self._inotify.names()
+				# Everything else (index, journal, lock...) changes too, only the log matters
+				if names is not None and self._name not in names:
+					continue
+			stamp = self._current_stamp()
+			if stamp != self._stamp:
+				self._stamp = stamp
+				return
+
+	def close(self):
+		if self._inotify is not None:
+			self._inotify.close()
+			self._inotify = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
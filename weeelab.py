@@ -21,66 +21,76 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import sys
 import argparse
+import re
 # For the copyright string in --help
 from argparse import RawDescriptionHelpFormatter
-from shutil import copy2
-# Allows using backspace and arrow keys in input
-# noinspection PyUnresolvedReferences
-import readline
 from datetime import datetime
-from time import sleep
-from select import select
-import subprocess
-import os
-
-if '--no-ldap' not in sys.argv:
-	from ldap.filter import escape_filter_chars
-	import ldap
-
+from typing import Optional, Pattern
 
 # import locals
 from constans import *
+import timing
+from output import FORMATS
+# Everything else (utils, daemon, subprocess, readline...) is imported only when needed, to start faster:
+# when the daemon answers, utils and LDAP are never imported at all
 
 
-def main(args_dict):
-	# root execution check
-	if os.geteuid() == 0:
-		print("Error: can't execute " + PROGRAM_NAME + " as root.")
-		exit(42)
+def run_direct(args_dict, socket_filename: Optional[str] = None) -> bool:
+	"""
+	Do what was asked right here, without the daemon
 
-	if args_dict.get('debug'):
-		global DEBUG_MODE
-		DEBUG_MODE = True
-		print(f"DEBUG_MODE enabled")
-		global LOG_FILENAME
-		LOG_FILENAME = "./debug/log.txt"
+	:param socket_filename: Daemon to hand interactive logins and logouts to, after asking the questions here
+	"""
+	import utils
+	from utils import LdapError, UserNotFoundError, LockTimeoutError
 
-	ensure_log_file()
-	create_backup_if_necessary()
+	utils.ensure_log_file()
+	utils.create_backup_if_necessary()
 
 	result = True
-	interactive = False
 	try:
 		if args_dict.get('login'):
-			login(args_dict.get('login')[0], args_dict.get('ldap'))
+			utils.login(args_dict.get('login')[0], args_dict.get('ldap'))
 		elif args_dict.get('logout'):
 			if args_dict.get('message') is None:
 				message = None
 			else:
 				message = args_dict.get('message')[0]
-			result = logout(args_dict.get('logout')[0], args_dict.get('ldap'), message)
+			result = utils.logout(args_dict.get('logout')[0], args_dict.get('ldap'), message)
 		elif args_dict.get('interactive_login'):
-			interactive = True
-			result = interactive_log(True, args_dict.get('ldap'))
+			result = utils.interactive_log(True, args_dict.get('ldap'), socket_filename)
 		elif args_dict.get('interactive_logout'):
-			interactive = True
-			result = interactive_log(False, args_dict.get('ldap'))
+			result = utils.interactive_log(False, args_dict.get('ldap'), socket_filename)
 		elif args_dict.get('inlab'):
-			inlab()
+			utils.inlab(args_dict.get('format'))
+		elif args_dict.get('watch'):
+			utils.watch_inlab()
 		elif args_dict.get('log'):
-			logfile()
+			utils.logfile(args_dict.get('format'), args_dict.get('tail'), args_dict.get('user'), args_dict.get('since'),
+						  args_dict.get('until'), args_dict.get('grep'))
+		elif args_dict.get('stats'):
+			utils.stats(args_dict.get('since'), args_dict.get('until'), args_dict.get('format'))
+		elif args_dict.get('totals'):
+			utils.print_totals(args_dict.get('format'))
+		elif args_dict.get('rebuild_summaries'):
+			utils.summaries()
 		elif args_dict.get('admin'):
-			result = manual_logout()
+			result = utils.manual_logout()
+		elif args_dict.get('close') is not None:
+			if args_dict.get('message') is None:
+				message = CLOSE_MESSAGE
+			else:
+				message = args_dict.get('message')[0]
+			# Nobody given means everyone
+			usernames = args_dict.get('close') or None
+			result = utils.close_sessions(usernames, args_dict.get('at') or datetime.now().strftime("%d/%m/%Y %H:%M"), message)
+		elif args_dict.get('batch'):
+			result = utils.replay_batch(args_dict.get('batch'), args_dict.get('ldap'), args_dict.get('dry_run'))
+		elif args_dict.get('refresh_user_cache'):
+			result = utils.refresh_user_cache()
+		elif args_dict.get('serve'):
+			from daemon import serve
+			result = serve(SOCKET_FILENAME)
 		else:
 			print("WTF?")
 			exit(69)
@@ -88,10 +98,97 @@ def main(args_dict):
 		result = False
 	except UserNotFoundError:
 		result = False
+	except LockTimeoutError:
+		result = False
+	return result
+
+
+def people_in_lab() -> int:
+	"""
+	How many people are in lab right now, for hooks: only they need utils when the daemon did the rest
+	"""
+	import utils
+	return utils.people_in_lab()
+
+
+def daemon_request(args_dict) -> Optional[dict]:
+	"""
+	Build a request for the daemon, if the action can be handled there all at once (interactive logins and logouts
+	ask their questions first, see utils.interactive_log)
+	"""
+	if args_dict.get('login'):
+		return {'action': 'login', 'username': args_dict.get('login')[0], 'ldap': args_dict.get('ldap')}
+	if args_dict.get('logout') and args_dict.get('message') is not None:
+		return {
+			'action': 'logout',
+			'username': args_dict.get('logout')[0],
+			'message': args_dict.get('message')[0],
+			'ldap': args_dict.get('ldap')
+		}
+	if args_dict.get('inlab'):
+		return {'action': 'inlab', 'format': args_dict.get('format'), 'ldap': args_dict.get('ldap')}
+	return None
+
+
+def action_name(args_dict) -> str:
+	"""
+	Which action has been chosen, for metrics
+	"""
+	for action in ('login', 'logout', 'interactive_login', 'interactive_logout', 'inlab', 'watch', 'log', 'admin',
+				   'close', 'batch', 'stats', 'totals', 'rebuild_summaries', 'refresh_user_cache', 'serve'):
+		# --close with no users is an empty list
+		if args_dict.get(action) not in (None, False):
+			return action
+	return "unknown"
+
+
+def main(args_dict):
+	# root execution check
+	if os.geteuid() == 0:
+		print("Error: can't execute " + PROGRAM_NAME + " as root.")
+		exit(42)
+
+	metrics_filename = args_dict.get('metrics')
+	if args_dict.get('profile') or metrics_filename:
+		timing.enable()
+
+	if args_dict.get('debug'):
+		import utils
+		utils.DEBUG_MODE = True
+		print(f"DEBUG_MODE enabled")
+		utils.LOG_FILENAME = "./debug/log.txt"
+
+	interactive = False
+	request = None
+	socket_filename = None
+	if args_dict.get('daemon') and not args_dict.get('debug'):
+		request = daemon_request(args_dict)
+		socket_filename = SOCKET_FILENAME
+	response = None
+	if request is not None:
+		from daemon import forward
+		request['profile'] = timing.enabled()
+		with timing.span("daemon"):
+			response = forward(SOCKET_FILENAME, request)
+
+	if response is not None:
+		print(response['output'], end='')
+		result = response['result']
+		first_in = response['first_in']
+		last_out = response['last_out']
+		sir = response['sir']
+		timing.add_spans(response.get('spans', []), "daemon/")
+	else:
+		result = run_direct(args_dict, socket_filename)
+		import utils
+		first_in = utils.FIRST_IN_HAPPENED
+		last_out = utils.LAST_OUT_HAPPENED
+		sir = utils.SIR_HAPPENED
+		interactive = args_dict.get('interactive_login') or args_dict.get('interactive_logout')
 
 	auto_close = True
 
-	if SIR_HAPPENED:
+	if sir:
 		red = "\033[41m\033[30m"
 		yellow = "\033[41m\033[97m"
 		border = "\033[103m"
@@ -120,25 +217,36 @@ def main(args_dict):
 		print(reset)
 		auto_close = False
 
-	if FIRST_IN_HAPPENED:
+	if first_in:
 		if FIRST_IN:
 			if os.path.isfile(FIRST_IN):
 				print("I'm now launching the \"first in\" script, but you can close this window")
-				subprocess.Popen([FIRST_IN])
+				import hooks
+				with timing.span("hook.first_in"):
+					hooks.trigger('first_in', FIRST_IN, lambda: people_in_lab() > 0)
 			else:
 				print(f"The \"first in\" script \"{FIRST_IN}\" does not exist, notify an administrator")
 
-	if LAST_OUT_HAPPENED:
+	if last_out:
 		if LAST_OUT:
 			if os.path.isfile(LAST_OUT):
 				print("I'm now launching the \"last out\" script, but you can close this window")
-				subprocess.Popen([LAST_OUT])
+				import hooks
+				with timing.span("hook.last_out"):
+					hooks.trigger('last_out', LAST_OUT, lambda: people_in_lab() == 0)
 			else:
 				print(f"The \"last out\" script \"{LAST_OUT}\" does not exist, notify an administrator")
 
+	# Waiting for enter below is not part of the work
+	if args_dict.get('profile'):
+		timing.print_report()
+	if metrics_filename:
+		timing.append_metrics(metrics_filename, action_name(args_dict), bool(result))
+
 	if interactive:
 		if auto_close and result:
 			print("Press enter to exit (or wait 10 seconds)")
+			from select import select
 			# does not work on windows:
 			select([sys.stdin], [], [], 10)
 		else:
@@ -147,7 +255,40 @@ def main(args_dict):
 			input()
 
 	if not result:
-		secure_exit(3)
+		sys.stdout.write(COLOR_NATIVE)
+		sys.exit(3)
+
+
+def parse_day(day: str) -> datetime:
+	try:
+		return datetime.strptime(day, "%d/%m/%Y")
+	except ValueError:
+		raise argparse.ArgumentTypeError(f"{day} is not a DD/MM/YYYY date")
+
+
+def parse_minute(minute: str) -> str:
+	try:
+		return datetime.strptime(minute, "%d/%m/%Y %H:%M").strftime("%d/%m/%Y %H:%M")
+	except ValueError:
+		raise argparse.ArgumentTypeError(f"{minute} is not a DD/MM/YYYY HH:MM time")
+
+
+def parse_count(count: str) -> int:
+	if not count.isdigit():
+		raise argparse.ArgumentTypeError(f"{count} is not a number of sessions")
+	return int(count)
+
+
+def parse_regex(pattern: str) -> Pattern:
+	try:
+		return re.compile(pattern)
+	except re.error as e:
+		raise argparse.ArgumentTypeError(f"{pattern} is not a valid regular expression: {e}")
+
+
+def parse_day_end(day: str) -> datetime:
+	# The whole day is included
+	return parse_day(day).replace(hour=23, minute=59, second=59)
 
 
 def argparse_this():
@@ -169,16 +310,51 @@ to redistribute it under the terms of the GNU GPLv3.
 	group.add_argument('--interactive-logout', action='store_true', help='log out with questions')
 	parser.add_argument('-m', '--message', type=str, nargs=1, metavar='MESSAGE', help='logout message')
 	group.add_argument('-p', '--inlab', action='store_true', help='show who\'s in lab (logged in)')
+	group.add_argument('--watch', action='store_true', help='show who\'s in lab and keep it updated, until ctrl+C')
 	group.add_argument('-l', '--log', action='store_true', help='show log file')
 	group.add_argument('-a', '--admin', action='store_true', help='enter admin mode')
+	group.add_argument('--close', type=str, nargs='*', metavar='USER',
+					   help='log out these users (everyone in lab if none) with the same time and message')
+	parser.add_argument('--at', type=parse_minute, metavar='"DD/MM/YYYY HH:MM"', help='logout time for --close (default: now)')
+	group.add_argument('--batch', type=str, metavar='FILE', help='apply logins and logouts from a CSV or JSONL file')
+	parser.add_argument('--dry-run', action='store_true', help='only check what --batch would do')
+	group.add_argument('--stats', action='store_true', help='show hours and sessions per user, from all log files')
+	group.add_argument('--totals', action='store_true', help='show total time in lab per user, from all log files')
+	group.add_argument('--rebuild-summaries', action='store_true', help='summarize and archive again every rotated log file')
+	parser.add_argument('--format', choices=FORMATS, default='text',
+						help='output of -p, -l, --stats and --totals: text for humans (default) or for programs')
+	parser.add_argument('--since', type=parse_day, metavar='DD/MM/YYYY', help='only sessions from this day on (for --stats and -l)')
+	parser.add_argument('--until', type=parse_day_end, metavar='DD/MM/YYYY', help='only sessions up to this day (for --stats and -l)')
+	parser.add_argument('--tail', type=parse_count, metavar='N', help='only the last N sessions (for -l)')
+	parser.add_argument('--user', type=str, metavar='USER', help='only sessions of USER (for -l)')
+	parser.add_argument('--grep', type=parse_regex, metavar='REGEX', help='only sessions whose line matches REGEX (for -l)')
+	group.add_argument('--refresh-user-cache', action='store_true', help='download all users from LDAP to the local cache')
+	group.add_argument('--serve', action='store_true', help='keep running and answer other weeelab instances on a socket')
 	ldap_group_argparse_thing = parser.add_mutually_exclusive_group(required=False)
 	ldap_group_argparse_thing.add_argument('--ldap', dest='ldap', action='store_true')
 	ldap_group_argparse_thing.add_argument('--no-ldap', dest='ldap', action='store_false')
 	ldap_group_argparse_thing.set_defaults(ldap=True)
+	daemon_group = parser.add_mutually_exclusive_group(required=False)
+	daemon_group.add_argument('--daemon', dest='daemon', action='store_true', help='use the running daemon, if any (default)')
+	daemon_group.add_argument('--no-daemon', dest='daemon', action='store_false', help='always do everything here')
+	daemon_group.set_defaults(daemon=True)
+	parser.add_argument('--profile', action='store_true', help='show how long each phase took')
+	parser.add_argument('--metrics', type=str, metavar='FILE', default=METRICS_FILENAME,
+						help='append timings of this run to FILE, as JSON lines')
 	args = parser.parse_args()
-	if args.message is not None and args.logout is None:
+	if args.message is not None and args.logout is None and args.close is None:
 		parser.error("You can't set a logout message alone or for other commands other than logout.\n"
-					 "You can use -m or its equivalent --message only if you also use the -o or --logout parameter.")
+					 "You can use -m or its equivalent --message only if you also use the -o, --logout or --close parameter.")
+	if args.at is not None and args.close is None:
+		parser.error("--at only works with --close")
+	if args.dry_run and args.batch is None:
+		parser.error("--dry-run only works with --batch")
+	if args.format != 'text' and not (args.inlab or args.log or args.stats or args.totals):
+		parser.error("--format only works with -p, -l, --stats and --totals")
+	if (args.since is not None or args.until is not None) and not (args.stats or args.log):
+		parser.error("--since and --until only work with --stats and -l")
+	if (args.tail is not None or args.user is not None or args.grep is not None) and not args.log:
+		parser.error("--tail, --user and --grep only work with -l")
 	return args
 
 